@@ -1,4 +1,6 @@
-import os, re, stat, fnmatch, platform, glob, traceback, shutil
+import os, re, stat, fnmatch, platform, glob, traceback, shutil, errno
+import hashlib, json, subprocess, time, threading, contextlib
+from concurrent.futures import ThreadPoolExecutor
 from conans import ConanFile, CMake, tools, RunEnvironment
 from conans.tools import Version
 from conans.errors import ConanInvalidConfiguration
@@ -151,7 +153,9 @@ clang_core_libs = [
   'clangARCMigrate',
 ]
 
-llvm_libs = llvm_core_libs + clang_core_libs
+# NOTE: llvm_core_libs already contains most of clang libs
+llvm_libs = llvm_core_libs + \
+  [library for library in clang_core_libs if library not in llvm_core_libs]
 
 # used by self.cpp_info.libs
 # If your project does not depend on LLVM libs (LibTooling, etc.),
@@ -401,6 +405,225 @@ llvm_env = {
   "LLVM_STATIC_LINK_CXX_STDLIB": None,
 }
 
+# Approximate peak memory (MiB) used by single compile or link job.
+# Used to derive number of compile and link jobs per stage
+# from available memory, see `_compile_jobs` and `_link_jobs`.
+job_memory_mb = {
+  "compile": 1024,
+  # sanitized code is instrumented i.e. compiles are heavier
+  "compile_sanitized": 1536,
+  "link_shared": 1536,
+  # stage_tmp_compiler links static clang, lld, lldb, etc.
+  "link_static": 4096,
+  "link_lto_thin": 6144,
+  "link_lto_full": 16384,
+}
+
+# cmake definitions that do not affect stage outputs
+# i.e. ignored by stage fingerprint, see `_stage_fingerprint`.
+fingerprint_ignored_definitions = [
+  "LLVM_PARALLEL_COMPILE_JOBS",
+  "LLVM_COMPILER_JOBS",
+  "LLVM_PARALLEL_LINK_JOBS",
+  "CMAKE_JOB_POOLS",
+  "CMAKE_JOB_POOL_COMPILE",
+  "CMAKE_JOB_POOL_LINK",
+  "CMAKE_C_COMPILER_LAUNCHER",
+  "CMAKE_CXX_COMPILER_LAUNCHER",
+  "CMAKE_C_LINKER_LAUNCHER",
+  "CMAKE_CXX_LINKER_LAUNCHER",
+  "LLVM_CCACHE_BUILD",
+]
+
+# linker flags that do not affect stage outputs
+# i.e. removed from cmake definitions by stage fingerprint, see `use_thinlto_cache`.
+fingerprint_ignored_flags = re.compile( \
+  r'\s*-Wl,--thinlto-(cache-dir|cache-policy|jobs)=\S*')
+
+# Job counts depend on memory available at configure time (see `_compile_jobs`),
+# so they (and ThinLTO flags, see `fingerprint_ignored_flags`)
+# do not trigger reconfigure, see `_cmake_configure_incremental`.
+# NOTE: skipped configure keeps job counts of previous configure.
+configure_ignored_definitions = [
+  "LLVM_PARALLEL_COMPILE_JOBS",
+  "LLVM_COMPILER_JOBS",
+  "LLVM_PARALLEL_LINK_JOBS",
+  "CMAKE_JOB_POOLS",
+]
+
+# Tools from stage_tmp_compiler used by next stages, see `use_stage_tmp_compiler_compiler`.
+# (cmake definition, tool in bin/, build target that produces tool, env. var. or None,
+#  project of stage_tmp_compiler that provides tool or None)
+stage_tmp_compiler_tools = [
+  # NOTE: use uninstrumented llvm-tblgen https://stackoverflow.com/q/56454026
+  # Full path to a native TableGen executable (usually named llvm-tblgen).
+  # This is intended for cross-compiling: if the user sets this variable,
+  # no native TableGen will be created.
+  ("LLVM_TABLEGEN", "llvm-tblgen", "llvm-tblgen", None, None),
+  # Same as LLVM_TABLEGEN, but for clang and lldb
+  # i.e. next stages do not build own clang-tblgen and lldb-tblgen.
+  ("CLANG_TABLEGEN", "clang-tblgen", "clang-tblgen", None, "clang"),
+  ("LLDB_TABLEGEN", "lldb-tblgen", "lldb-tblgen", None, "lldb"),
+  ("CMAKE_C_COMPILER", "clang", "clang", None, "clang"),
+  # clang++ is symlink created by `clang` target
+  ("CMAKE_CXX_COMPILER", "clang++", "clang", None, "clang"),
+  ("LLVM_SYMBOLIZER_PATH", "llvm-symbolizer", "llvm-symbolizer", "SYMBOLIZER", None),
+  ("LLVM_CONFIG_PATH", "llvm-config", "llvm-config", "LLVM_CONFIG_PATH", None),
+]
+
+# x86-64 microarchitecture levels as explicit feature flags,
+# because clang 9 and old gcc do not support `-march=x86-64-v3`, etc.
+# see https://gitlab.com/x86-psABIs/x86-64-ABI
+x86_64_levels = {
+  "x86-64-v2": ["-mcx16", "-msahf", "-mpopcnt", "-msse3", "-mssse3", "-msse4.1", "-msse4.2"],
+}
+x86_64_levels["x86-64-v3"] = x86_64_levels["x86-64-v2"] \
+  + ["-mavx", "-mavx2", "-mbmi", "-mbmi2", "-mf16c", "-mfma", "-mlzcnt", "-mmovbe", "-mxsave"]
+x86_64_levels["x86-64-v4"] = x86_64_levels["x86-64-v3"] \
+  + ["-mavx512f", "-mavx512bw", "-mavx512cd", "-mavx512dq", "-mavx512vl"]
+
+# LLVM targets compiled by instrumented clang to collect profile
+# if no training corpus provided, see `build_stage_pgo`.
+pgo_training_targets = [
+  'LLVMSupport',
+  'LLVMCore',
+  'LLVMAnalysis',
+  'LLVMTransformUtils',
+]
+
+# targets built and installed by stage_runtime
+stage_runtime_targets = [
+  'cxx',
+  'cxxabi'
+]
+
+# stage_runtime builds both shared and static runtime libraries
+# in separate build folders (in parallel), see `build_stage_runtime`.
+# (variant, value of BUILD_SHARED_LIBS)
+stage_runtime_variants = [
+  ('shared', "ON"),
+  ('static', "OFF"),
+]
+
+# Files (relative to package folder, fnmatch patterns, `*` matches `/`)
+# kept by each `package_part`, see `_prune_package_parts`.
+# Shared libs (`shared=True` or `dylib=True`) are added to "toolchain" and "tools".
+package_parts = {
+  # compilers, linkers, LTO plugin and clang resource headers
+  "toolchain": [
+    "bin/*",
+    "libexec/*",
+    "lib/clang/*/include/*",
+    "lib/LLVMgold*",
+    "lib/libLTO*",
+    "share/*",
+  ],
+  # LLVM/clang libs, headers and cmake exports.
+  # NOTE: exports reference installed executables (llvm-tblgen, etc.),
+  # so binaries are kept too.
+  "devel": [
+    "bin/*",
+    "include/*",
+    "lib/*",
+    "clang/*",
+    "tools/*",
+  ],
+  # libc++, libc++abi, libunwind, compiler-rt (clang_rt.*)
+  "runtime": [
+    "include/c++/*",
+    "lib/libc++*",
+    "lib/libunwind*",
+    "lib/clang/*/lib/*",
+    "lib/clang/*/share/*",
+  ],
+  # include-what-you-use and clang-tools (lint-only pipelines)
+  "tools": [
+    "bin/include-what-you-use",
+    "bin/iwyu*",
+    "bin/fix_includes.py",
+    "bin/clang-format",
+    "bin/git-clang-format",
+    "bin/clang-tidy",
+    "bin/run-clang-tidy*",
+    "bin/clang-apply-replacements",
+    "bin/clang-query",
+    "bin/clang-include-fixer",
+    "bin/clangd",
+    "lib/clang/*/include/*",
+    "share/include-what-you-use/*",
+    "share/clang/*",
+  ],
+}
+
+package_shared_lib_patterns = [
+  "lib/lib*.so*",
+  "lib/lib*.dylib",
+]
+
+# ioctl to clone file extents (reflink) on Linux (btrfs, xfs, etc.)
+# see `man ioctl_ficlone`
+FICLONE = 0x40049409
+
+# Increment to invalidate all stages stored in the stage store
+# (i.e. if you changed something in recipe that affects stage outputs,
+# but not stage fingerprint).
+stage_store_version = 1
+
+# Compiler and linker launcher that records duration of each step
+# in format similar to `.ninja_log`, see `use_build_timing`.
+# Used only if generator is not Ninja (Ninja writes `.ninja_log` itself).
+# usage: python timing_launcher.py <log> <command...>
+timing_launcher_script = '''import os, subprocess, sys, time
+log, command = sys.argv[1], sys.argv[2:]
+start = time.time()
+returncode = subprocess.call(command)
+end = time.time()
+output = command[command.index("-o") + 1] if "-o" in command[:-1] else command[-1]
+with open(log, "a") as f:
+  f.write("{}\\t{}\\t{}\\n".format(int(start * 1000), int(end * 1000), os.path.abspath(output)))
+sys.exit(returncode)
+'''
+
+# Runtimes built by stage_llvm are linked into consumer programs,
+# so they must run on any CPU i.e. are not tuned by `march` and `mtune`.
+target_cpu_excluded_projects = [
+  'compiler-rt',
+  'libcxx',
+  'libcxxabi',
+  'libunwind',
+  'openmp',
+]
+
+# Included right after `project(LLVM)` (see CMAKE_PROJECT_LLVM_INCLUDE),
+# adds LLVM_CONAN_TARGET_CPU_FLAGS to all targets
+# except targets defined in LLVM_CONAN_TARGET_CPU_EXCLUDED_DIRS.
+# NOTE: $<IN_LIST> requires CMake 3.12
+target_cpu_flags_script = '''# generated by conanfile.py, see `use_target_cpu_flags`
+separate_arguments(_llvm_conan_flags UNIX_COMMAND "${LLVM_CONAN_TARGET_CPU_FLAGS}")
+string(REPLACE ";" "$<SEMICOLON>" _llvm_conan_dirs "${LLVM_CONAN_TARGET_CPU_EXCLUDED_DIRS}")
+foreach(_llvm_conan_flag ${_llvm_conan_flags})
+  add_compile_options("$<$<NOT:$<IN_LIST:$<TARGET_PROPERTY:SOURCE_DIR>,${_llvm_conan_dirs}>>:${_llvm_conan_flag}>")
+endforeach()
+'''
+
+build_log_compile_re = re.compile(r'\.(o|obj)$')
+build_log_link_re = re.compile(r'(\.(a|so(\.[0-9]+)*|dylib|dll|lib|exe)$)|(^bin/[^/.]+$)')
+
+# Installed cmake exports, parsed by `_write_llvm_components`.
+cmake_exports = [
+  "lib/cmake/llvm/LLVMExports.cmake",
+  "lib/cmake/clang/ClangTargets.cmake",
+]
+cmake_export_library_re = re.compile( \
+  r'^add_library\((\S+) (STATIC|SHARED|MODULE|INTERFACE) IMPORTED\)', re.MULTILINE)
+cmake_export_properties_re = re.compile( \
+  r'^set_target_properties\((\S+) PROPERTIES\n(.*?)^\)', re.MULTILINE | re.DOTALL)
+cmake_export_link_libraries_re = re.compile(r'INTERFACE_LINK_LIBRARIES "([^"]*)"')
+cmake_export_link_only_re = re.compile(r'^\$<LINK_ONLY:([^>]+)>$')
+
+# version of `llvm_components.json`
+llvm_components_version = 1
+
 def get_name(default):
     envvar = os.getenv("LLVM_PACKAGE_NAME", default)
     return envvar
@@ -498,8 +721,48 @@ class LLVM9Conan(ConanFile):
         # as the objects inside the archive will be LLVM bitcode,
         # which is not portable.
         'lto': ['On', 'Off', 'Full', 'Thin'],
+        # Build clang of stage_llvm with profile-guided optimization:
+        # build instrumented clang, compile training workload with it
+        # and use merged profile in stage_llvm (see LLVM_PROFDATA_FILE).
+        # Requires stage_tmp_compiler.
+        'pgo': [True, False],
+        # Tune stage_llvm and iwyu (i.e. packaged clang, lld, etc.) for CPU:
+        # any `-march` value (i.e. "skylake") except "native"
+        # or x86-64 microarchitecture level ("x86-64-v2", "x86-64-v3", "x86-64-v4").
+        # NOTE: package can not be used on older CPUs.
+        # NOTE: runtimes (compiler-rt, etc.) are not tuned.
+        'march': "ANY",
+        'mtune': "ANY",
+        # Build all stages with debug info (`-g`), i.e. RelWithDebInfo-like Release build
+        'debug_info': [True, False],
+        # Keep debug info in `.dwo` files (LLVM_USE_SPLIT_DWARF, `-gsplit-dwarf`),
+        # reduces link time and link memory. Requires debug_info.
+        'split_dwarf': [True, False],
+        # Compress debug sections with zlib (`-gz`). Requires debug_info and libz.
+        'compress_debug_sections': [True, False],
         'fPIC': [True, False],
         'shared': [True, False],
+        # Build single libLLVM and libclang-cpp shared libraries
+        # and link tools of stage_llvm with them
+        # (see LLVM_LINK_LLVM_DYLIB and CLANG_LINK_CLANG_DYLIB).
+        # Faster startup of tools than `shared=True` (one library instead of dozens)
+        # and faster links of consumers than static libs.
+        # Requires `shared=False` (can not be used with BUILD_SHARED_LIBS).
+        'dylib': [True, False],
+        # "full" copies stage_llvm build folder and clang sources into package,
+        # "lean" copies only files installed by stage_llvm (see install_manifest.txt)
+        # i.e. headers, libraries, binaries and cmake exports.
+        'package_layout': ['full', 'lean'],
+        # "all" or one of independently consumable parts:
+        # "toolchain", "devel", "runtime", "tools" (see `package_parts`).
+        # All parts reuse same stages (see stage store).
+        'package_part': ['all', 'toolchain', 'devel', 'runtime', 'tools'],
+        # strips ELF executables and shared libs in package,
+        # debug info is kept in `.debug` folders (linked by `.gnu_debuglink`)
+        'split_debug_info': [True, False],
+        # if enabled, `.debug` folders are packaged,
+        # otherwise they are kept in `<build_folder>/debug_info`
+        'package_debug_info': [True, False],
         'rtti': [True, False],
         'threads': [True, False],
         # Build LLVM with exception-handling support.
@@ -540,6 +803,11 @@ class LLVM9Conan(ConanFile):
         'use_sanitizer': 'None',
         'fPIC': True,
         'shared': True,
+        'dylib': False,
+        'package_layout': 'full',
+        'package_part': 'all',
+        'split_debug_info': False,
+        'package_debug_info': False,
         'exceptions': False,
         'unwind_tables': True,
         'rtti': False,
@@ -547,6 +815,12 @@ class LLVM9Conan(ConanFile):
         'libffi': False,
         'libz': True,
         'lto': 'Off',
+        'pgo': False,
+        'march': "None",
+        'mtune': "None",
+        'debug_info': False,
+        'split_dwarf': False,
+        'compress_debug_sections': False,
         "include_what_you_use": True,
         "add_to_builddirs": True,
         "add_to_libdirs": True,
@@ -609,13 +883,738 @@ class LLVM9Conan(ConanFile):
             pass
         return None
 
+    def _read_first_line(self, path):
+      try:
+        with open(path, 'r') as f:
+          return f.readline().strip()
+      except (OSError, IOError):
+        return None
+
+    # CPU limit from cgroup v2 `cpu.max` or cgroup v1 `cpu.cfs_quota_us`.
+    # Returns None if not limited.
     @property
-    def _fit_cpu_count(self):
-      # don't hang all CPUs and force OS to kill build process
-      cpu_count = max(tools.cpu_count() - 2, 1)
-      self.output.info('Detected %s CPUs' % (cpu_count))
+    def _cgroup_cpu_limit(self):
+      cpu_max = self._read_first_line("/sys/fs/cgroup/cpu.max")
+      if cpu_max:
+        quota, period = cpu_max.split()[:2]
+        if quota != "max":
+          return max(int(int(quota) / int(period)), 1)
+        return None
+      quota = self._read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+      period = self._read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+      if quota and period and int(quota) > 0:
+        return max(int(int(quota) / int(period)), 1)
+      return None
+
+    # Memory (bytes) that can be used by build process
+    # i.e. min of `MemAvailable` and free memory in cgroup (v2 or v1).
+    @property
+    def _available_memory(self):
+      available = None
+      try:
+        with open("/proc/meminfo", 'r') as f:
+          for line in f:
+            if line.startswith("MemAvailable:"):
+              available = int(line.split()[1]) * 1024
+      except (OSError, IOError):
+        pass
+      for limit_path, usage_path in [ \
+          ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"), \
+          ("/sys/fs/cgroup/memory/memory.limit_in_bytes", \
+           "/sys/fs/cgroup/memory/memory.usage_in_bytes")]:
+        limit = self._read_first_line(limit_path)
+        usage = self._read_first_line(usage_path)
+        # cgroup v1 reports huge number if not limited
+        if limit and usage and limit != "max" and int(limit) < (1 << 60):
+          cgroup_available = max(int(limit) - int(usage), 0)
+          available = cgroup_available if available is None \
+            else min(available, cgroup_available)
+          break
+      return available
+
+    @property
+    def _available_cpu_count(self):
+      cpu_count = tools.cpu_count()
+      if hasattr(os, "sched_getaffinity"):
+        cpu_count = min(cpu_count, len(os.sched_getaffinity(0)))
+      if self._cgroup_cpu_limit:
+        cpu_count = min(cpu_count, self._cgroup_cpu_limit)
       return cpu_count
 
+    def _compile_job_memory_mb(self, stage):
+      if os.getenv("LLVM_CONAN_COMPILE_JOB_MEMORY_MB"):
+        return int(os.getenv("LLVM_CONAN_COMPILE_JOB_MEMORY_MB"))
+      if stage == "stage_runtime" and self._has_sanitizers:
+        return job_memory_mb["compile_sanitized"]
+      return job_memory_mb["compile"]
+
+    def _link_job_memory_mb(self, stage):
+      if os.getenv("LLVM_CONAN_LINK_JOB_MEMORY_MB"):
+        return int(os.getenv("LLVM_CONAN_LINK_JOB_MEMORY_MB"))
+      if self.options.lto == "Thin":
+        return job_memory_mb["link_lto_thin"]
+      if self.options.lto in ["On", "Full"]:
+        return job_memory_mb["link_lto_full"]
+      # NOTE: instrumented clang of stage_pgo is linked statically
+      if stage in ["stage_tmp_compiler", "stage_pgo"] \
+         or (stage in ["stage_llvm", "iwyu"] and not self.options.shared):
+        return job_memory_mb["link_static"]
+      return job_memory_mb["link_shared"]
+
+    # Backend threads per ThinLTO link job.
+    # Link jobs are limited by memory (see `_link_jobs`),
+    # so each link job can use its share of CPUs.
+    def _thinlto_jobs(self, stage):
+      return max(self._available_cpu_count // self._link_jobs(stage), 1)
+
+    def _jobs_fit_in_memory(self, job_memory_mb):
+      available = self._available_memory
+      if available is None:
+        return None
+      # keep some memory for OS and page cache
+      reserved = int(os.getenv("LLVM_CONAN_RESERVED_MEMORY_MB", "2048"))
+      return max(int(available / (1024 * 1024) - reserved) // job_memory_mb, 1)
+
+    # Ninja has lower no-op overhead than Makefiles
+    # and LLVM uses Ninja job pools (see LLVM_PARALLEL_LINK_JOBS)
+    # to limit number of parallel compile and link jobs.
+    # NOTE: LLVM 9 has no separate job pool for tablegen,
+    # tablegen commands run in default pool (limited by `--parallel`).
+    @property
+    def _use_ninja(self):
+      return self.flag_to_cmake(os.getenv("LLVM_CONAN_USE_NINJA", "OFF")) == "ON"
+
+    def _new_cmake(self):
+      generator = None
+      if self._use_ninja:
+        if not tools.which("ninja"):
+          raise Exception("Unable to find ninja. Install ninja or disable LLVM_CONAN_USE_NINJA")
+        generator = "Ninja"
+      cmake = CMake(self, generator=generator, set_cmake_flags=True)
+      cmake.verbose = True
+      # NOTE: `--parallel` is passed explicitly, see `_cmake_build`
+      # (otherwise conan appends own `-j` that overrides our job count)
+      cmake.parallel = False
+      return cmake
+
+    # NOTE: telemetry uses name of build folder,
+    # stage may use multiple build folders (see `build_stage_runtime`).
+    def _cmake_configure(self, cmake, stage, source_folder, build_folder):
+      with self._telemetry("{}/configure".format(os.path.basename(build_folder))), \
+           tools.environment_append(self._compiler_cache_env(stage)):
+        if not self._incremental_configure_enabled:
+          cmake.configure(source_folder=source_folder, build_folder=build_folder)
+          return
+        self._cmake_configure_incremental(cmake, stage, source_folder, build_folder)
+
+    # Incremental configure skips configure if cmake definitions
+    # did not change since last configure of build folder.
+    @property
+    def _incremental_configure_enabled(self):
+      return self.flag_to_cmake(os.getenv("LLVM_CONAN_INCREMENTAL_CONFIGURE", "ON")) == "ON"
+
+    def _configure_state_path(self, build_folder):
+      return os.path.join(build_folder, ".conan_configure.json")
+
+    # Returns value of cache entry from CMakeCache.txt or None.
+    def _cmake_cache_value(self, build_folder, name):
+      cache = os.path.join(build_folder, "CMakeCache.txt")
+      if not os.path.exists(cache):
+        return None
+      with open(cache, 'r') as f:
+        for line in f:
+          if line.startswith(name + ":"):
+            return line.rstrip("\n").split("=", 1)[1]
+      return None
+
+    def _cmake_configure_incremental(self, cmake, stage, source_folder, build_folder):
+      source_folder = os.path.join(self.source_folder, source_folder)
+      state = {
+        "definitions": {name: fingerprint_ignored_flags.sub("", str(value)) \
+          for name, value in cmake.definitions.items() \
+          if name not in configure_ignored_definitions},
+        "generator": cmake.generator,
+        "source_folder": source_folder,
+      }
+      fingerprint = hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+      state_path = self._configure_state_path(build_folder)
+
+      old_state = {}
+      if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+          old_state = json.load(f)
+
+      cache = os.path.join(build_folder, "CMakeCache.txt")
+      if old_state.get("fingerprint") == fingerprint and os.path.exists(cache):
+        self.output.info('{}: cmake definitions not changed, skipping configure of {}'.format( \
+          stage, build_folder))
+        # same as `cmake.configure` does
+        cmake.build_dir = build_folder
+        return
+
+      # CMake can not change generator of existing build folder
+      # and refuses to use cache from other build folder (i.e. restored from stage store).
+      # Without names of previous definitions stale ones can not be removed (see below).
+      if os.path.exists(cache) \
+         and (old_state.get("generator") != cmake.generator \
+              or "definitions" not in old_state \
+              or self._cmake_cache_value(build_folder, "CMAKE_CACHEFILE_DIR") \
+                 != os.path.abspath(build_folder)):
+        self.output.info('{}: removing {}'.format(stage, cache))
+        os.remove(cache)
+        shutil.rmtree(os.path.join(build_folder, "CMakeFiles"), ignore_errors=True)
+
+      if not os.path.exists(build_folder):
+        os.makedirs(build_folder)
+      if os.path.exists(state_path):
+        os.remove(state_path)
+
+      # Pass definitions via initial cache file (`cmake -C`),
+      # FORCE overrides values from existing CMakeCache.txt.
+      # Definitions passed by previous configure, but not by this one
+      # (i.e. CMAKE_PROJECT_LLVM_INCLUDE without `march`) are removed from cache.
+      removed_definitions = sorted(set(old_state.get("definitions", [])) - set(cmake.definitions))
+      initial_cache = os.path.join(build_folder, "conan_initial_cache.cmake")
+      with open(initial_cache, 'w') as f:
+        for name in removed_definitions:
+          f.write('unset({} CACHE)\n'.format(name))
+        for name, value in sorted(cmake.definitions.items()):
+          value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+          f.write('set({} "{}" CACHE STRING "" FORCE)\n'.format(name, value))
+
+      definitions = cmake.definitions
+      cmake.definitions = {}
+      try:
+        cmake.configure(source_folder=source_folder, build_folder=build_folder, \
+          args=["-C", initial_cache])
+      finally:
+        cmake.definitions = definitions
+
+      with open(state_path, 'w') as f:
+        json.dump({"fingerprint": fingerprint, "generator": cmake.generator, \
+                   "definitions": sorted(cmake.definitions)}, f)
+
+    # `cmake --build` with generator-agnostic arguments
+    # i.e. works with both Makefiles and Ninja (requires CMake >= 3.12).
+    # `target` may be a list: all targets are built by one `cmake --build` call
+    # (CMake >= 3.15), so parallelism does not drain between targets.
+    def _cmake_build(self, cmake, stage, target=None):
+      targets = target if isinstance(target, list) else [target] if target else []
+      if len(targets) > 1 and self._cmake_version is not None and self._cmake_version < "3.15":
+        for target in targets:
+          self._cmake_build(cmake, stage, target=target)
+        return
+      with self._telemetry("{}/build{}".format(os.path.basename(cmake.build_folder), \
+                                               ":" + ",".join(targets) if targets else "")), \
+           tools.environment_append(self._compiler_cache_env(stage)):
+        args = (["--target"] + targets if targets else []) \
+          + ["--parallel", str(self._compile_jobs(stage))]
+        cmake.build(args=args)
+
+    def _cmake_install(self, cmake, stage):
+      with self._telemetry("{}/install".format(os.path.basename(cmake.build_folder))), \
+           tools.environment_append(self._compiler_cache_env(stage)):
+        cmake.install(args=["--parallel", str(self._compile_jobs(stage))])
+
+    # Telemetry records wall time, CPU time, peak RSS of process tree,
+    # bytes written and build folder size for every stage
+    # and every configure, build and install step.
+    # Cheap enough to keep enabled in CI:
+    # process tree RSS is sampled once per LLVM_CONAN_TELEMETRY_INTERVAL seconds.
+    @property
+    def _telemetry_enabled(self):
+      return self.flag_to_cmake(os.getenv("LLVM_CONAN_TELEMETRY", "ON")) == "ON"
+
+    @property
+    def _telemetry_report_path(self):
+      return os.path.join(os.path.dirname(self.build_folder), \
+        "{}.telemetry.json".format(os.path.basename(self.build_folder)))
+
+    # Sum of RSS (bytes) of this process and all its descendants.
+    # Returns None if /proc is not available.
+    def _process_tree_rss(self):
+      if not os.path.isdir("/proc"):
+        return None
+      page_size = os.sysconf("SC_PAGE_SIZE")
+      children = {}
+      rss = {}
+      for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+          continue
+        try:
+          with open("/proc/{}/stat".format(pid), 'r') as f:
+            # process name can contain spaces, so skip it
+            fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IOError, IndexError):
+          continue
+        # fields[1] is ppid, fields[21] is rss in pages, see `man proc`
+        children.setdefault(int(fields[1]), []).append(int(pid))
+        rss[int(pid)] = int(fields[21]) * page_size
+      total = 0
+      pids = [os.getpid()]
+      while pids:
+        pid = pids.pop()
+        total += rss.get(pid, 0)
+        pids.extend(children.get(pid, []))
+      return total
+
+    # Bytes written to storage by this process and its finished children.
+    def _bytes_written(self):
+      try:
+        with open("/proc/self/io", 'r') as f:
+          for line in f:
+            if line.startswith("write_bytes:"):
+              return int(line.split()[1])
+      except (OSError, IOError):
+        pass
+      return None
+
+    # Disk usage (bytes) of folder, hardlinked files are counted once.
+    def _folder_size(self, folder):
+      total = 0
+      seen_inodes = set()
+      folders = [folder]
+      while folders:
+        try:
+          entries = list(os.scandir(folders.pop()))
+        except (OSError, IOError):
+          continue
+        for entry in entries:
+          if entry.is_symlink():
+            continue
+          if entry.is_dir():
+            folders.append(entry.path)
+            continue
+          entry_stat = entry.stat()
+          if entry_stat.st_ino in seen_inodes:
+            continue
+          seen_inodes.add(entry_stat.st_ino)
+          total += entry_stat.st_blocks * 512 \
+            if hasattr(entry_stat, "st_blocks") else entry_stat.st_size
+      return total
+
+    def _cpu_times(self):
+      try:
+        import resource
+      except ImportError:
+        return (0.0, 0.0)
+      usage_self = resource.getrusage(resource.RUSAGE_SELF)
+      usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+      return (usage_self.ru_utime + usage_children.ru_utime, \
+              usage_self.ru_stime + usage_children.ru_stime)
+
+    def _telemetry_sampler(self):
+      interval = float(os.getenv("LLVM_CONAN_TELEMETRY_INTERVAL", "2"))
+      while not self._telemetry_stop.wait(interval):
+        rss = self._process_tree_rss()
+        if rss is None:
+          return
+        with self._telemetry_lock:
+          for record in self._telemetry_active:
+            record["peak_rss"] = max(record["peak_rss"] or 0, rss)
+
+    @contextlib.contextmanager
+    def _telemetry(self, name, folder=None):
+      if not self._telemetry_enabled:
+        yield
+        return
+      if not hasattr(self, "_telemetry_records"):
+        self._telemetry_records = []
+        self._telemetry_active = []
+        self._telemetry_lock = threading.Lock()
+      record = {"name": name, "peak_rss": self._process_tree_rss()}
+      start_time = time.time()
+      start_cpu = self._cpu_times()
+      start_written = self._bytes_written()
+      with self._telemetry_lock:
+        self._telemetry_active.append(record)
+        if len(self._telemetry_active) == 1:
+          self._telemetry_stop = threading.Event()
+          self._telemetry_thread = threading.Thread(target=self._telemetry_sampler)
+          self._telemetry_thread.daemon = True
+          self._telemetry_thread.start()
+      try:
+        yield
+        record["status"] = "ok"
+      except BaseException:
+        record["status"] = "failed"
+        raise
+      finally:
+        end_cpu = self._cpu_times()
+        end_written = self._bytes_written()
+        record["wall_time"] = time.time() - start_time
+        record["user_time"] = end_cpu[0] - start_cpu[0]
+        record["sys_time"] = end_cpu[1] - start_cpu[1]
+        record["bytes_written"] = end_written - start_written \
+          if end_written is not None and start_written is not None else None
+        if folder:
+          record["folder_size"] = self._folder_size(folder)
+        with self._telemetry_lock:
+          self._telemetry_active.remove(record)
+          if not self._telemetry_active:
+            self._telemetry_stop.set()
+          self._telemetry_records.append(record)
+
+    def _report_telemetry(self):
+      if not self._telemetry_enabled or not hasattr(self, "_telemetry_records"):
+        return
+      with open(self._telemetry_report_path, 'w') as f:
+        json.dump({
+          "name": self.name,
+          "version": self.version,
+          "build_folder": self.build_folder,
+          "stage_fingerprints": self._stage_fingerprints,
+          "records": self._telemetry_records,
+        }, f, indent=2)
+      self.output.info('telemetry report: {}'.format(self._telemetry_report_path))
+      mib = lambda value: "-" if value is None else str(value // (1024 * 1024))
+      self.output.info('{:<40} {:>6} {:>10} {:>10} {:>10} {:>14} {:>14} {:>14}'.format( \
+        "step", "status", "wall (s)", "user (s)", "sys (s)", "peak RSS (MiB)", "written (MiB)", "folder (MiB)"))
+      for record in self._telemetry_records:
+        self.output.info('{:<40} {:>6} {:>10.0f} {:>10.0f} {:>10.0f} {:>14} {:>14} {:>14}'.format( \
+          record["name"], record["status"], record["wall_time"], record["user_time"], \
+          record["sys_time"], mib(record["peak_rss"]), mib(record["bytes_written"]), \
+          mib(record.get("folder_size"))))
+
+    # Compiler cache used as CMAKE_<LANG>_COMPILER_LAUNCHER by all stages.
+    # Possible values are "ccache", "sccache" and "None".
+    @property
+    def _compiler_cache(self):
+      compiler_cache = os.getenv("LLVM_CONAN_COMPILER_CACHE", "None")
+      if compiler_cache not in ["ccache", "sccache", "None"]:
+        raise Exception("Unknown LLVM_CONAN_COMPILER_CACHE: {}. Allowed values: ccache, sccache, None".format(compiler_cache))
+      return None if compiler_cache == "None" else compiler_cache
+
+    # Each stage and sanitizer uses own cache folder,
+    # so sanitized and uninstrumented objects never evict each other.
+    def _compiler_cache_folder(self, stage):
+      return os.path.join( \
+        os.getenv("LLVM_CONAN_COMPILER_CACHE_DIR", \
+          os.path.join(self._llvm_cache_root, str(self._compiler_cache))), \
+        "{}-{}".format(stage, str(self.options.use_sanitizer).replace(";", "_")))
+
+    def _compiler_cache_env(self, stage):
+      if not self._compiler_cache:
+        return {}
+      cache_size = os.getenv("LLVM_CONAN_COMPILER_CACHE_SIZE", "20G")
+      if self._compiler_cache == "sccache":
+        return {
+          "SCCACHE_DIR": self._compiler_cache_folder(stage),
+          "SCCACHE_CACHE_SIZE": cache_size,
+        }
+      env = {
+        "CCACHE_DIR": self._compiler_cache_folder(stage),
+        "CCACHE_MAXSIZE": cache_size,
+        # use relative paths, so different build folders share cache entries
+        "CCACHE_BASEDIR": self.build_folder,
+      }
+      # compiler from stage_tmp_compiler is rebuilt (or restored) with new mtime,
+      # so identify it by stage fingerprint instead of mtime
+      if stage != "stage_tmp_compiler" and self._stage_tmp_compiler_enabled \
+         and self._stage_fingerprints.get("stage_tmp_compiler"):
+        env["CCACHE_COMPILERCHECK"] = "string:{}".format( \
+          self._stage_fingerprints["stage_tmp_compiler"])
+      return env
+
+    def _run_compiler_cache(self, stage, args):
+      env = dict(os.environ)
+      env.update(self._compiler_cache_env(stage))
+      return subprocess.check_output([self._compiler_cache] + args, \
+        env=env, stderr=subprocess.STDOUT).decode()
+
+    def use_compiler_cache(self, cmake, stage):
+      if not self._compiler_cache:
+        return
+      launcher = tools.which(self._compiler_cache)
+      if not launcher:
+        raise Exception("Unable to find {}".format(self._compiler_cache))
+      cmake.definitions["CMAKE_C_COMPILER_LAUNCHER"]=launcher
+      cmake.definitions["CMAKE_CXX_COMPILER_LAUNCHER"]=launcher
+      # LLVM_CCACHE_BUILD uses RULE_LAUNCH_COMPILE i.e. will conflict with launcher
+      cmake.definitions["LLVM_CCACHE_BUILD"]="OFF"
+      if self._compiler_cache == "sccache":
+        # sccache server must be restarted to use SCCACHE_DIR of new stage
+        try:
+          self._run_compiler_cache(stage, ["--stop-server"])
+        except subprocess.CalledProcessError:
+          pass
+      # zero statistics, so we can report per-stage statistics
+      self._run_compiler_cache(stage, ["--zero-stats"])
+
+    def _collect_compiler_cache_stats(self, stage):
+      if not self._compiler_cache:
+        return
+      try:
+        if self._compiler_cache == "sccache":
+          stats = json.loads(self._run_compiler_cache(stage, \
+            ["--show-stats", "--stats-format", "json"]))
+          self._compiler_cache_stats[stage] = {
+            "hits": sum(stats["stats"]["cache_hits"]["counts"].values()),
+            "misses": sum(stats["stats"]["cache_misses"]["counts"].values()),
+            "size": stats.get("cache_size") or 0,
+          }
+        else:
+          # key-value pairs separated by tab (ccache >= 3.7)
+          stats = dict(line.split('\t')[:2] for line in \
+            self._run_compiler_cache(stage, ["--print-stats"]).splitlines() \
+            if '\t' in line)
+          self._compiler_cache_stats[stage] = {
+            "hits": int(stats.get("direct_cache_hit", 0)) \
+              + int(stats.get("preprocessed_cache_hit", 0)),
+            "misses": int(stats.get("cache_miss", 0)),
+            "size": int(stats.get("cache_size_kibibyte", 0)) * 1024,
+          }
+      except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+        self.output.warn('{}: unable to get {} statistics: {}'.format(stage, self._compiler_cache, str(e)))
+
+    def _report_compiler_cache_stats(self):
+      if not self._compiler_cache:
+        return
+      self.output.info('{} statistics:'.format(self._compiler_cache))
+      self.output.info('{:<20} {:>10} {:>10} {:>8} {:>12}'.format( \
+        "stage", "hits", "misses", "hit rate", "size (MiB)"))
+      for stage, stats in self._compiler_cache_stats.items():
+        total = stats["hits"] + stats["misses"]
+        hit_rate = "{:.1f}%".format(100.0 * stats["hits"] / total) if total else "-"
+        self.output.info('{:<20} {:>10} {:>10} {:>8} {:>12}'.format( \
+          stage, stats["hits"], stats["misses"], hit_rate, stats["size"] // (1024 * 1024)))
+
+    # Analyzer of build logs reports slowest compile and link steps,
+    # critical path and estimate of achievable parallelism for each stage.
+    # Uses `.ninja_log` and `ninja -t graph` with Ninja generator
+    # or log written by timing launcher otherwise (no critical path in that case).
+    @property
+    def _build_analysis_enabled(self):
+      # Ninja writes `.ninja_log` anyway,
+      # other generators run every compile and link step via timing launcher (opt-in)
+      return self.flag_to_cmake(os.getenv("LLVM_CONAN_ANALYZE_BUILD", \
+        "ON" if self._use_ninja else "OFF")) == "ON"
+
+    # Version of CMake used by recipe or None if unknown.
+    @property
+    def _cmake_version(self):
+      if not hasattr(self, "_cmake_version_value"):
+        self._cmake_version_value = None
+        try:
+          output = subprocess.check_output( \
+            [os.getenv("CONAN_CMAKE_PROGRAM", "cmake"), "--version"], universal_newlines=True)
+          match = re.search(r'version ([0-9]+\.[0-9]+(\.[0-9]+)?)', output)
+          if match:
+            self._cmake_version_value = tools.Version(match.group(1))
+        except (subprocess.CalledProcessError, OSError):
+          pass
+      return self._cmake_version_value
+
+    @property
+    def _build_analysis_report_path(self):
+      return os.path.join(os.path.dirname(self.build_folder), \
+        "{}.build_analysis.json".format(os.path.basename(self.build_folder)))
+
+    def _timing_log_path(self, folder):
+      return os.path.join(folder, ".conan_timing_log")
+
+    # Must be called after `use_compiler_cache`
+    # (timing launcher wraps compiler cache launcher).
+    def use_build_timing(self, cmake, stage, folder):
+      if not self._build_analysis_enabled:
+        return
+      if self._use_ninja:
+        # parse only entries appended by this build, see `_analyze_build_log`
+        ninja_log = os.path.join(folder, ".ninja_log")
+        self._build_log_offsets[stage] = \
+          os.path.getsize(ninja_log) if os.path.exists(ninja_log) else 0
+        return
+      # NOTE: sys.executable is conan itself if conan is installed as executable
+      python = tools.which("python3") or tools.which("python")
+      if not python:
+        self.output.warn('{}: unable to find python3, build timing disabled'.format(stage))
+        return
+      if os.path.exists(self._timing_log_path(folder)):
+        os.remove(self._timing_log_path(folder))
+      script = os.path.join(self.build_folder, "timing_launcher.py")
+      with open(script, 'w') as f:
+        f.write(timing_launcher_script)
+      launcher = ";".join([python, script, self._timing_log_path(folder)])
+      for lang in ["C", "CXX"]:
+        compiler_launcher = cmake.definitions.get("CMAKE_{}_COMPILER_LAUNCHER".format(lang))
+        cmake.definitions["CMAKE_{}_COMPILER_LAUNCHER".format(lang)] = \
+          launcher + (";" + compiler_launcher if compiler_launcher else "")
+        cmake.definitions["CMAKE_{}_LINKER_LAUNCHER".format(lang)] = launcher
+      if self._cmake_version is None or self._cmake_version < "3.21":
+        self.output.warn('{}: CMAKE_<LANG>_LINKER_LAUNCHER requires CMake >= 3.21 (found {}), ' \
+          'link steps will not be analyzed'.format(stage, self._cmake_version or "unknown"))
+
+    # Returns list of (duration ms, [outputs]) for steps of last build in folder.
+    def _read_build_log(self, stage, folder):
+      steps = {}
+      ninja_log = os.path.join(folder, ".ninja_log")
+      if self._use_ninja and os.path.exists(ninja_log):
+        offset = self._build_log_offsets.get(stage, 0)
+        with open(ninja_log, 'r') as f:
+          # `ninja -t recompact` may rewrite log
+          if os.path.getsize(ninja_log) >= offset:
+            f.seek(offset)
+          for line in f:
+            if line.startswith("#"):
+              continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 5:
+              continue
+            # multiple outputs of one step share command hash and times
+            # start and end are relative to start of ninja invocation
+            start, end, _, output, command_hash = fields
+            steps.setdefault((command_hash, start, end), []).append(output)
+      elif os.path.exists(self._timing_log_path(folder)):
+        with open(self._timing_log_path(folder), 'r') as f:
+          for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 3:
+              continue
+            start, end, output = fields
+            steps.setdefault((output, start, end), []).append(os.path.relpath(output, folder))
+      return [(int(end) - int(start), outputs) for (_, start, end), outputs in steps.items()]
+
+    # Returns {output: [inputs]} parsed from `ninja -t graph`.
+    def _read_ninja_graph(self, folder):
+      graph = subprocess.check_output(["ninja", "-C", folder, "-t", "graph"], \
+        universal_newlines=True)
+      labels = {}
+      edges = []
+      for line in graph.splitlines():
+        match = re.match(r'^"(0x[0-9a-f]+)" -> "(0x[0-9a-f]+)"', line)
+        if match:
+          edges.append(match.groups())
+          continue
+        match = re.match(r'^"(0x[0-9a-f]+)" \[label="([^"]*)"(, shape=ellipse)?', line)
+        if match:
+          # ellipse is build step with multiple inputs or outputs
+          labels[match.group(1)] = None if match.group(3) else match.group(2)
+      step_inputs = {}
+      step_outputs = {}
+      inputs = {}
+      for src, dst in edges:
+        if src in labels and labels[src] is None:
+          step_outputs.setdefault(src, []).append(labels.get(dst))
+        elif dst in labels and labels[dst] is None:
+          step_inputs.setdefault(dst, []).append(labels.get(src))
+        else:
+          inputs.setdefault(labels.get(dst), []).append(labels.get(src))
+      for step, outputs in step_outputs.items():
+        for output in outputs:
+          inputs.setdefault(output, []).extend(step_inputs.get(step, []))
+      return inputs
+
+    # Longest path weighted by step durations, returns (duration ms, [outputs]).
+    def _critical_path(self, inputs, durations):
+      longest = {}
+      for root in inputs:
+        # iterative post-order traversal, DAG is deep
+        pending = [(root, False)]
+        while pending:
+          node, visited = pending.pop()
+          if node in longest:
+            continue
+          node_inputs = [i for i in inputs.get(node, []) if i not in longest]
+          if not visited and node_inputs:
+            pending.append((node, True))
+            pending.extend((i, False) for i in node_inputs)
+            continue
+          best = max([(longest[i][0], i) for i in inputs.get(node, []) if i in longest] \
+                     or [(0, None)])
+          longest[node] = (best[0] + durations.get(node, 0), best[1])
+      if not longest:
+        return (0, [])
+      node = max(longest, key=lambda n: longest[n][0])
+      duration = longest[node][0]
+      path = []
+      while node is not None:
+        if durations.get(node):
+          path.append(node)
+        node = longest[node][1]
+      return (duration, list(reversed(path)))
+
+    def _analyze_build_log(self, stage, folder, jobs=None):
+      if not self._build_analysis_enabled:
+        return
+      steps = self._read_build_log(stage, folder)
+      if not steps:
+        self.output.warn('{}: no build log to analyze in {}'.format(stage, folder))
+        return
+      top_n = int(os.getenv("LLVM_CONAN_ANALYZE_TOP_N", "20"))
+      top = lambda regex: [{"duration": duration / 1000.0, "outputs": outputs} \
+        for duration, outputs in sorted(steps, key=lambda s: -s[0]) \
+        if any(regex.search(output) for output in outputs)][:top_n]
+      total = sum(duration for duration, _ in steps)
+      analysis = {
+        "steps": len(steps),
+        "total_step_time": total / 1000.0,
+        "slowest_compile_steps": top(build_log_compile_re),
+        "slowest_link_steps": top(build_log_link_re),
+        "critical_path": None,
+        "achievable_parallelism": None,
+        "jobs": jobs or self._compile_jobs(stage),
+      }
+      if self._use_ninja:
+        durations = {}
+        for duration, outputs in steps:
+          for output in outputs:
+            durations[output] = duration
+        try:
+          duration, path = self._critical_path(self._read_ninja_graph(folder), durations)
+          analysis["critical_path"] = {"duration": duration / 1000.0, "outputs": path}
+          # NOTE: with unlimited cores and RAM build can not be faster than critical path
+          analysis["achievable_parallelism"] = float(total) / duration if duration else None
+        except (subprocess.CalledProcessError, OSError) as e:
+          self.output.warn('{}: unable to get build graph: {}'.format(stage, str(e)))
+      self._build_analysis[stage] = analysis
+
+    def _report_build_analysis(self):
+      if not self._build_analysis_enabled or not self._build_analysis:
+        return
+      with open(self._build_analysis_report_path, 'w') as f:
+        json.dump(self._build_analysis, f, indent=2)
+      self.output.info('build analysis report: {}'.format(self._build_analysis_report_path))
+      for stage, analysis in self._build_analysis.items():
+        self.output.info('{}: {} steps, {:.0f} s total step time'.format( \
+          stage, analysis["steps"], analysis["total_step_time"]))
+        if analysis["critical_path"]:
+          self.output.info('{}: critical path {:.0f} s, achievable parallelism {:.1f}, jobs {}'.format( \
+            stage, analysis["critical_path"]["duration"], \
+            analysis["achievable_parallelism"] or 0, analysis["jobs"]))
+        for kind in ["slowest_compile_steps", "slowest_link_steps"]:
+          for step in analysis[kind]:
+            self.output.info('{}: {:>8.1f} s {}'.format(stage, step["duration"], step["outputs"][0]))
+
+    # Number of parallel compile jobs for stage.
+    # Limited by available CPUs (cgroup quota and affinity aware)
+    # and by available memory.
+    def _compile_jobs(self, stage):
+      if os.getenv("LLVM_PARALLEL_COMPILE_JOBS"):
+        return int(os.getenv("LLVM_PARALLEL_COMPILE_JOBS"))
+      # don't hang all CPUs and force OS to kill build process
+      reserved_cpus = int(os.getenv("LLVM_CONAN_RESERVED_CPUS", "2"))
+      jobs = max(self._available_cpu_count - reserved_cpus, 1)
+      memory_jobs = self._jobs_fit_in_memory(self._compile_job_memory_mb(stage))
+      if memory_jobs:
+        jobs = min(jobs, memory_jobs)
+      self.output.info('{}: {} compile jobs'.format(stage, jobs))
+      return jobs
+
+    # Number of parallel link jobs for stage (see LLVM_PARALLEL_LINK_JOBS).
+    # Links are much more memory hungry than compiles, especially LTO links.
+    def _link_jobs(self, stage):
+      if os.getenv("LLVM_PARALLEL_LINK_JOBS"):
+        return int(os.getenv("LLVM_PARALLEL_LINK_JOBS"))
+      jobs = self._compile_jobs(stage)
+      memory_jobs = self._jobs_fit_in_memory(self._link_job_memory_mb(stage))
+      if memory_jobs:
+        jobs = min(jobs, memory_jobs)
+      else:
+        # unable to detect available memory
+        jobs = 1
+      self.output.info('{}: {} link jobs'.format(stage, jobs))
+      return jobs
+
     # TODO: failed to change compiler
     # llvm-ar: warning: creating t.a
     # llvm-ranlib: error: Exactly one archive should be specified.
@@ -626,6 +1625,51 @@ class LLVM9Conan(ConanFile):
     def _stage_tmp_compiler_enabled(self):
       return self.flag_to_cmake(os.getenv("LLVM_stage_tmp_compiler_ENABLED", "ON")) == "ON"
 
+    # Build only targets of stage_tmp_compiler that are used by next stages
+    # (see `stage_tmp_compiler_tools`) instead of all projects.
+    @property
+    def _stage_tmp_compiler_minimal(self):
+      return self.flag_to_cmake(os.getenv("LLVM_CONAN_MINIMAL_BOOTSTRAP", "OFF")) == "ON"
+
+    # Link next stages with lld from stage_tmp_compiler
+    # instead of system linker (usually BFD ld).
+    @property
+    def _use_lld(self):
+      default = "ON" if self._stage_tmp_compiler_enabled else "OFF"
+      return self._stage_tmp_compiler_enabled \
+        and self.flag_to_cmake(os.getenv("LLVM_CONAN_USE_LLD", default)) == "ON"
+
+    # `stage_tmp_compiler_tools` provided by projects enabled in stage_tmp_compiler.
+    @property
+    def _stage_tmp_compiler_tools(self):
+      projects = self._stage_tmp_compiler_llvm_projects
+      return [tool for tool in stage_tmp_compiler_tools \
+        if tool[4] is None or tool[4] in projects]
+
+    # Returns None if all targets must be built.
+    @property
+    def _stage_tmp_compiler_targets(self):
+      if not self._stage_tmp_compiler_minimal:
+        return None
+      targets = []
+      for definition, tool, target, env_name, project in self._stage_tmp_compiler_tools:
+        if target not in targets:
+          targets.append(target)
+      # clang can not compile anything without stddef.h, etc.
+      targets.append("clang-resource-headers")
+      if self._use_lld:
+        # see `use_stage_tmp_compiler_linker`
+        targets.append("lld")
+      if self._has_sanitizers or self.options.pgo:
+        # `-fsanitize=` requires sanitizer runtimes in clang resource dir
+        # (i.e. cmake checks in sanitized stage_runtime will fail without them)
+        # `-fprofile-generate` requires profile runtime
+        targets.append("compiler-rt")
+      if self.options.pgo:
+        # merges profiles, see `build_stage_pgo`
+        targets.append("llvm-profdata")
+      return targets
+
     @property
     def _stage_tmp_compiler_folder(self):
       return '{}/stage_tmp_compiler'.format(self.build_folder)
@@ -634,10 +1678,34 @@ class LLVM9Conan(ConanFile):
     def _stage_runtime_folder(self):
       return '{}/stage_runtime'.format(self.build_folder)
 
+    # Build folder of stage_runtime variant, see `stage_runtime_variants`.
+    # NOTE: all variants install into `_stage_runtime_folder`
+    def _stage_runtime_variant_folder(self, variant):
+      return '{}/stage_runtime_{}'.format(self.build_folder, variant)
+
+    # Parallel jobs per stage_runtime variant
+    # i.e. variants are built concurrently and share job budget.
+    def _stage_runtime_variant_jobs(self, jobs):
+      return max(jobs // len(stage_runtime_variants), 1)
+
+    # Contains only merged profile, see `build_stage_pgo`
+    @property
+    def _stage_pgo_folder(self):
+      return '{}/stage_pgo'.format(self.build_folder)
+
+    @property
+    def _stage_pgo_profdata(self):
+      return '{}/clang.profdata'.format(self._stage_pgo_folder)
+
     @property
     def _stage_llvm_folder(self):
       return '{}/stage_llvm'.format(self.build_folder)
 
+    # see `package_layout` option
+    @property
+    def _stage_llvm_install_folder(self):
+      return '{}/install'.format(self._stage_llvm_folder)
+
     @property
     def _iwyu_folder(self):
       return '{}/iwyu'.format(self.build_folder)
@@ -708,6 +1776,18 @@ class LLVM9Conan(ConanFile):
       # NOTE: ignores getattr(self.options, 'with_' + project)
       stage_tmp_compiler_llvm_projects = [project for project in llvm_projects \
         if self.project_allowed_on_stage_tmp_compiler(project)]
+      if self._stage_tmp_compiler_minimal:
+        # projects that provide `_stage_tmp_compiler_targets`
+        minimal_projects = ['clang']
+        if self._has_sanitizers or self.options.pgo:
+          minimal_projects.append('compiler-rt')
+        if self.resolve_option('lldb'):
+          # provides lldb-tblgen for stage_llvm
+          minimal_projects.append('lldb')
+        if self._use_lld:
+          minimal_projects.append('lld')
+        stage_tmp_compiler_llvm_projects = [project for project in stage_tmp_compiler_llvm_projects \
+          if project in minimal_projects]
       self.output.info('Enabled LLVM stage_tmp_compiler subprojects: {}'.format(', '.join(stage_tmp_compiler_llvm_projects)))
       return stage_tmp_compiler_llvm_projects
 
@@ -751,25 +1831,23 @@ class LLVM9Conan(ConanFile):
       self.output.info('Enabled LLVM stage_llvm runtimes: {}'.format(', '.join(stage_llvm_llvm_runtimes)))
       return stage_llvm_llvm_runtimes
 
+    # see `stage_tmp_compiler_tools`
     def use_stage_tmp_compiler_compiler(self, cmake):
-        # NOTE: use uninstrumented llvm-tblgen https://stackoverflow.com/q/56454026
-        llvm_tblgen = "{}/bin/llvm-tblgen".format(self._stage_tmp_compiler_folder)
-        if not os.path.exists(llvm_tblgen):
-            raise Exception("Unable to find path: {}".format(llvm_tblgen))
-        # Full path to a native TableGen executable (usually named llvm-tblgen).
-        # This is intended for cross-compiling: if the user sets this variable,
-        # no native TableGen will be created.
-        cmake.definitions["LLVM_TABLEGEN"]=llvm_tblgen
-
-        llvm_clang = "{}/bin/clang".format(self._stage_tmp_compiler_folder)
-        if not os.path.exists(llvm_clang):
-            raise Exception("Unable to find path: {}".format(llvm_clang))
-        cmake.definitions["CMAKE_C_COMPILER"]=llvm_clang
-
-        llvm_clangpp = "{}/bin/clang++".format(self._stage_tmp_compiler_folder)
-        if not os.path.exists(llvm_clangpp):
-            raise Exception("Unable to find path: {}".format(llvm_clangpp))
-        cmake.definitions["CMAKE_CXX_COMPILER"]=llvm_clangpp
+        for definition, tool, target, env_name, project in self._stage_tmp_compiler_tools:
+          tool_path = "{}/bin/{}".format(self._stage_tmp_compiler_folder, tool)
+          if not os.path.exists(tool_path):
+              raise Exception("Unable to find path: {}".format(tool_path))
+          cmake.definitions[definition]=tool_path
+          if env_name:
+            os.environ.update({env_name: tool_path})
+
+        # Tablegens are provided by stage_tmp_compiler,
+        # so do not create NATIVE sub-build (see LLVM_USE_HOST_TOOLS)
+        # to build optimized tablegens once again.
+        cmake.definitions["LLVM_OPTIMIZED_TABLEGEN"]="OFF"
+
+        if self._use_lld:
+          self.use_stage_tmp_compiler_linker(cmake)
 
         # TODO: use llvm-ar or llvm-lib?
         # llvm_ar = "{}/bin/llvm-ar".format(self._stage_tmp_compiler_folder)
@@ -844,18 +1922,6 @@ class LLVM9Conan(ConanFile):
         #     raise Exception("Unable to find path: {}".format(llvm_ranlib))
         # cmake.definitions["CMAKE_RANLIB"]=llvm_ranlib
 
-        llvm_symbolizer = "{}/bin/llvm-symbolizer".format(self._stage_tmp_compiler_folder)
-        if not os.path.exists(llvm_symbolizer):
-            raise Exception("Unable to find path: {}".format(llvm_symbolizer))
-        cmake.definitions['LLVM_SYMBOLIZER_PATH'] = llvm_symbolizer
-        os.environ.update({"SYMBOLIZER": llvm_symbolizer})
-
-        llvm_config = "{}/bin/llvm-config".format(self._stage_tmp_compiler_folder)
-        if not os.path.exists(llvm_config):
-            raise Exception("Unable to find path: {}".format(llvm_config))
-        cmake.definitions['LLVM_CONFIG_PATH'] = llvm_config
-        os.environ.update({"LLVM_CONFIG_PATH": llvm_config})
-
         # To prevent cmake from checking libstdcxx version.
         # cmake.definitions['LLVM_ENABLE_LIBCXX'] = 'ON'
 
@@ -929,27 +1995,567 @@ class LLVM9Conan(ConanFile):
         #   self.prepend_to_definition(cmake, "CMAKE_SHARED_LINKER_FLAGS", item)
         #   self.prepend_to_definition(cmake, "CMAKE_MODULE_LINKER_FLAGS", item)
 
+    # Persistent ThinLTO cache (shared by rebuilds of stage)
+    # i.e. rebuild does not redo backend codegen of unchanged modules.
+    # NOTE: LLVM enables own ThinLTO cache in build folder
+    # only if LLVM_USE_LINKER is "lld" or "gold".
+    # NOTE: requires lld from stage_tmp_compiler (see `use_stage_tmp_compiler_linker`),
+    # `-plugin-opt` flags of LLVMgold.so break links without plugin
+    # (i.e. links without `-flto`, cmake checks, gcc toolchain).
+    def use_thinlto_cache(self, cmake, stage):
+        if stage == "stage_tmp_compiler" or not self._use_lld:
+          self.output.info('{}: ThinLTO cache requires lld (see LLVM_CONAN_USE_LLD), skipping'.format(stage))
+          return
+
+        cache_dir = os.path.join( \
+          os.getenv("LLVM_CONAN_THINLTO_CACHE_DIR", os.path.join(self._llvm_cache_root, "thinlto")), \
+          stage)
+        if not os.path.exists(cache_dir):
+          os.makedirs(cache_dir)
+        cache_policy = os.getenv("LLVM_CONAN_THINLTO_CACHE_POLICY", "prune_after=168h:cache_size_bytes=20g")
+        jobs = self._thinlto_jobs(stage)
+
+        ldflags = ["-Wl,--thinlto-cache-dir={}".format(cache_dir), \
+                   "-Wl,--thinlto-cache-policy={}".format(cache_policy), \
+                   "-Wl,--thinlto-jobs={}".format(jobs)]
+        self.output.info('{}: ThinLTO cache {}, {} backend threads per link job'.format( \
+          stage, cache_dir, jobs))
+        for item in ldflags:
+          self.prepend_to_definition(cmake, "CMAKE_EXE_LINKER_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_SHARED_LINKER_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_MODULE_LINKER_FLAGS", item)
+
+    @property
+    def _march(self):
+      return None if str(self.options.march) == "None" else str(self.options.march)
+
+    @property
+    def _mtune(self):
+      return None if str(self.options.mtune) == "None" else str(self.options.mtune)
+
+    # LLVM architecture (as in target triple) required by `march` or None if unknown.
+    @property
+    def _march_arch(self):
+      if self._march in x86_64_levels:
+        return "x86_64"
+      return None
+
+    def _check_march_target(self, cmake):
+      arch = self._march_arch
+      if not arch:
+        return
+      normalize = lambda value: value.lower().replace("-", "_").replace("amd64", "x86_64")
+      target_arch = cmake.definitions.get("LLVM_TARGET_ARCH") or os.getenv("LLVM_TARGET_ARCH")
+      if target_arch and target_arch.lower() != "host" \
+         and normalize(target_arch) not in [normalize(arch), "x86"]:
+        self.output.warn('march={} builds for {}, but LLVM_TARGET_ARCH={}'.format( \
+          self._march, arch, target_arch))
+      triple = cmake.definitions.get("LLVM_DEFAULT_TARGET_TRIPLE") or os.getenv("LLVM_DEFAULT_TARGET_TRIPLE")
+      if triple and normalize(triple.split("-")[0]) != normalize(arch):
+        self.output.warn('march={} builds for {}, but LLVM_DEFAULT_TARGET_TRIPLE={}'.format( \
+          self._march, arch, triple))
+
+    # Folders (with CMakeLists.txt) of LLVM projects,
+    # as in SOURCE_DIR of targets defined there.
+    def _cmake_source_dirs(self, projects):
+      dirs = []
+      for project in projects:
+        project_dir = os.path.normpath(os.path.join( \
+          self.source_folder, self._llvm_source_subfolder, project))
+        for root, _, files in os.walk(project_dir):
+          if "CMakeLists.txt" in files:
+            dirs.append(root)
+      return sorted(dirs)
+
+    # Used only by stage_llvm and iwyu i.e. by packaged tools,
+    # stage_runtime and runtimes of `excluded_projects` must run on any CPU.
+    def use_target_cpu_flags(self, cmake, excluded_projects=None):
+        excluded_projects = excluded_projects or []
+        if not self._march and not self._mtune:
+          return
+        cflags = []
+        if self._march in x86_64_levels:
+          cflags.append("-march=x86-64")
+          cflags.extend(x86_64_levels[self._march])
+        elif self._march:
+          cflags.append("-march={}".format(self._march))
+        if self._mtune:
+          cflags.append("-mtune={}".format(self._mtune))
+        self._check_march_target(cmake)
+        self.output.info('target CPU flags: {}'.format(" ".join(cflags)))
+
+        excluded_dirs = self._cmake_source_dirs(excluded_projects)
+        if not excluded_dirs:
+          for item in reversed(cflags):
+            self.prepend_to_definition(cmake, "CMAKE_C_FLAGS", item)
+            self.prepend_to_definition(cmake, "CMAKE_CXX_FLAGS", item)
+          return
+
+        # CMAKE_C_FLAGS would be used by runtimes too
+        self.output.info('target CPU flags are not used by: {}'.format(", ".join(excluded_projects)))
+        script_path = os.path.join(self.build_folder, "conan_target_cpu_flags.cmake")
+        with open(script_path, 'w') as f:
+          f.write(target_cpu_flags_script)
+        cmake.definitions["CMAKE_PROJECT_LLVM_INCLUDE"]=script_path
+        cmake.definitions["LLVM_CONAN_TARGET_CPU_FLAGS"]=" ".join(cflags)
+        cmake.definitions["LLVM_CONAN_TARGET_CPU_EXCLUDED_DIRS"]=";".join(excluded_dirs)
+
+    # see `debug_info`, `split_dwarf` and `compress_debug_sections` options.
+    def use_debug_info_flags(self, cmake):
+        if not self.options.debug_info:
+          return
+        cflags = ["-g"]
+        ldflags = []
+        if self.options.split_dwarf:
+          # `.dwo` files are combined into `.dwp` by package(), see `_package_dwp_files`
+          cflags.append("-gsplit-dwarf")
+        if self.options.compress_debug_sections:
+          cflags.append("-gz")
+          ldflags.append("-Wl,--compress-debug-sections=zlib")
+        for item in reversed(cflags):
+          self.prepend_to_definition(cmake, "CMAKE_C_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_CXX_FLAGS", item)
+        for item in ldflags:
+          self.prepend_to_definition(cmake, "CMAKE_EXE_LINKER_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_SHARED_LINKER_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_MODULE_LINKER_FLAGS", item)
+
+    # NOTE: uses linker flags instead of LLVM_USE_LINKER,
+    # because iwyu does not use LLVM cmake modules.
+    def use_stage_tmp_compiler_linker(self, cmake):
+        llvm_ld = "{}/bin/ld.lld".format(self._stage_tmp_compiler_folder)
+        if not os.path.exists(llvm_ld):
+            raise Exception("Unable to find path: {}".format(llvm_ld))
+
+        # clang accepts full path to linker in `-fuse-ld`
+        ldflags = ["-fuse-ld={}".format(llvm_ld)]
+        # NOTE: lld 9 links multi-threaded by default, flag makes it explicit
+        ldflags.append("-Wl,--threads")
+        if self._lower_build_type in ["debug", "relwithdebinfo"] or self.options.split_dwarf:
+          # speeds up loading of debug info in gdb
+          # (with split DWARF gdb otherwise has to read all `.dwo` files)
+          ldflags.append("-Wl,--gdb-index")
+        for item in ldflags:
+          self.prepend_to_definition(cmake, "CMAKE_EXE_LINKER_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_SHARED_LINKER_FLAGS", item)
+          self.prepend_to_definition(cmake, "CMAKE_MODULE_LINKER_FLAGS", item)
+
+    @property
+    def _copy_jobs(self):
+      # copying is I/O bound, so use more threads than CPUs
+      return int(os.getenv("LLVM_CONAN_COPY_JOBS", "16"))
+
+    # Walks `src` only once and returns manifest
+    # i.e. list of (kind, src, dst, stat) where kind is "dir", "symlink" or "file".
     # Do not copy large files
     # https://stackoverflow.com/a/13814557
-    def copytree(self, src, dst, symlinks=False, ignore=None, verbose=False):
-        if not os.path.exists(dst):
-            os.makedirs(dst)
+    def _copy_manifest(self, src, dst, symlinks=True, ignore=None, verbose=False):
         ignore_list = ['.travis.yml', '.git', '.make', '.o', '.obj', '.marks', \
                        '.internal', 'CMakeFiles', 'CMakeCache', 'static_test_env', \
                        'test']
-        for item in os.listdir(src):
-            if item not in ignore_list:
-              s = os.path.join(src, item)
-              d = os.path.join(dst, item)
+        manifest = [("dir", src, dst, None)]
+        folders = [(src, dst)]
+        while folders:
+          src_folder, dst_folder = folders.pop()
+          entries = list(os.scandir(src_folder))
+          ignored = set(ignore(src_folder, [entry.name for entry in entries])) \
+            if ignore else set()
+          for entry in entries:
+            if entry.name in ignore_list or entry.name in ignored:
               if verbose:
-                self.output.info('copying %s into %d' % (s, d))
-              if os.path.isdir(s):
-                  self.copytree(s, d, symlinks, ignore)
-              else:
-                  if not os.path.exists(d) or os.stat(s).st_mtime - os.stat(d).st_mtime > 1:
-                      shutil.copy2(s, d)
-            elif verbose:
-              self.output.info('IGNORED copying %s' % (item))
+                self.output.info('IGNORED copying %s' % (entry.path))
+              continue
+            d = os.path.join(dst_folder, entry.name)
+            if symlinks and entry.is_symlink():
+              manifest.append(("symlink", entry.path, d, None))
+            elif entry.is_dir():
+              manifest.append(("dir", entry.path, d, None))
+              folders.append((entry.path, d))
+            else:
+              manifest.append(("file", entry.path, d, entry.stat()))
+        return manifest
+
+    # Possible values are:
+    # "copy" - regular copy.
+    # "link" - reflink (copy-on-write clone) if filesystem supports it,
+    #          hardlink if source and package are on same device,
+    #          regular copy as last resort.
+    @property
+    def _package_link_mode(self):
+      link_mode = os.getenv("LLVM_CONAN_PACKAGE_LINK_MODE", "copy")
+      if link_mode not in ["copy", "link"]:
+        raise Exception("Unknown LLVM_CONAN_PACKAGE_LINK_MODE: {}. Allowed values: copy, link".format(link_mode))
+      return link_mode
+
+    # Returns False if filesystem does not support reflinks.
+    def _reflink_file(self, src, dst):
+        import fcntl
+        try:
+          with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except (OSError, IOError) as e:
+          if os.path.exists(dst):
+            os.remove(dst)
+          if e.errno in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, \
+                         errno.EINVAL, errno.ENOSYS, errno.EBADF]:
+            return False
+          raise
+        shutil.copystat(src, dst)
+        return True
+
+    # NOTE: hardlinked file shares inode with file in stage folder.
+    # Packaged file stays untouched on stage rebuilds only because
+    # tools that re-create outputs (linkers, archivers, cmake `file(INSTALL)`)
+    # unlink old file before writing new one.
+    # Tool that modifies file in place changes packaged file too,
+    # so never hardlink files that may be edited in place (i.e. source trees).
+    def _hardlink_file(self, src, dst):
+        if os.stat(src).st_dev != os.stat(os.path.dirname(dst)).st_dev:
+          return False
+        os.link(src, dst)
+        return True
+
+    def _copy_file(self, src, dst, hardlinks=True):
+        if self._package_link_mode == "link":
+          # cache result per device pair, so we do not retry failed reflinks
+          devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+          if self._reflink_supported.get(devices, True):
+            if self._reflink_file(src, dst):
+              return
+            self._reflink_supported[devices] = False
+          if hardlinks and self._hardlink_file(src, dst):
+            return
+        shutil.copy2(src, dst)
+
+    # Returns True if file was copied, False if unchanged file skipped.
+    def _copy_manifest_file(self, src, dst, src_stat, hardlinks=True):
+        try:
+          dst_stat = os.lstat(dst)
+          if stat.S_ISLNK(dst_stat.st_mode):
+            os.remove(dst)
+          elif dst_stat.st_size == src_stat.st_size \
+             and abs(dst_stat.st_mtime - src_stat.st_mtime) <= 1:
+            return False
+          else:
+            os.remove(dst)
+        except FileNotFoundError:
+          pass
+        self._copy_file(src, dst, hardlinks)
+        return True
+
+    @property
+    def _reflink_supported(self):
+      if not hasattr(self, "_reflink_supported_devices"):
+        self._reflink_supported_devices = {}
+      return self._reflink_supported_devices
+
+    def _copy_manifest_symlink(self, src, dst):
+        link = os.readlink(src)
+        if os.path.lexists(dst):
+          if os.path.islink(dst) and os.readlink(dst) == link:
+            return
+          if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+          else:
+            os.remove(dst)
+        os.symlink(link, dst)
+
+    # Replacement for recursive copy:
+    # walks tree once, than copies files on thread pool.
+    # Keeps symlinks intact and skips files with unchanged size and mtime.
+    # `hardlinks=False` allows only reflinks or copies in "link" mode.
+    def copytree(self, src, dst, symlinks=True, ignore=None, verbose=False, hardlinks=True):
+        manifest = self._copy_manifest(src, dst, symlinks, ignore, verbose)
+        self._copy_from_manifest(manifest, src, dst, hardlinks)
+
+    # Copies files listed in cmake `install_manifest.txt`
+    # (absolute paths of installed files under `prefix`) into `dst`.
+    def copy_install_manifest(self, install_manifest, prefix, dst):
+        if not os.path.exists(install_manifest):
+          raise Exception("Unable to find path: {}".format(install_manifest))
+        manifest = [("dir", prefix, dst, None)]
+        folders = set()
+        with open(install_manifest, 'r') as f:
+          paths = [line.strip() for line in f if line.strip()]
+        for path in paths:
+          relpath = os.path.relpath(path, prefix)
+          if relpath.startswith(".."):
+            self.output.warn('{} is not installed into {}, skipping'.format(path, prefix))
+            continue
+          if not os.path.lexists(path):
+            raise Exception("Unable to find installed file: {}".format(path))
+          folder = os.path.dirname(relpath)
+          while folder and folder not in folders:
+            folders.add(folder)
+            folder = os.path.dirname(folder)
+          path_stat = os.lstat(path)
+          kind = "symlink" if stat.S_ISLNK(path_stat.st_mode) else "file"
+          manifest.append((kind, path, os.path.join(dst, relpath), path_stat))
+        # parents before children
+        manifest.extend(("dir", os.path.join(prefix, folder), os.path.join(dst, folder), None) \
+          for folder in sorted(folders, key=lambda folder: folder.count(os.sep)))
+        self._copy_from_manifest(manifest, prefix, dst)
+
+    def _copy_from_manifest(self, manifest, src, dst, hardlinks=True):
+        # create folders first, in walk order
+        for kind, s, d, _ in manifest:
+          if kind == "dir" and not os.path.isdir(d):
+            os.makedirs(d)
+
+        for kind, s, d, _ in manifest:
+          if kind == "symlink":
+            self._copy_manifest_symlink(s, d)
+
+        files = [(s, d, st) for kind, s, d, st in manifest if kind == "file"]
+        with ThreadPoolExecutor(max_workers=self._copy_jobs) as executor:
+          copied = list(executor.map(lambda item: self._copy_manifest_file(*item, hardlinks), files))
+
+        copied_size = sum(st.st_size for (s, d, st), was_copied in zip(files, copied) if was_copied)
+        self.output.info('copied {} into {}: {} files ({} MiB), {} unchanged, {} symlinks'.format( \
+          src, dst, copied.count(True), copied_size // (1024 * 1024), \
+          copied.count(False), len([item for item in manifest if item[0] == "symlink"])))
+
+    # Root folder for persistent caches that must survive
+    # between package revisions (stage store, etc.)
+    @property
+    def _llvm_cache_root(self):
+      return os.getenv("LLVM_CONAN_CACHE_ROOT", \
+        os.path.join(os.path.expanduser("~"), ".conan", "llvm_9_cache"))
+
+    # Stage store keeps outputs of already built stages
+    # (content-addressed by stage fingerprint),
+    # so unchanged stages can be restored instead of rebuilt.
+    @property
+    def _stage_store_enabled(self):
+      return self.flag_to_cmake(os.getenv("LLVM_CONAN_STAGE_STORE_ENABLED", "ON")) == "ON"
+
+    @property
+    def _stage_store_folder(self):
+      return os.getenv("LLVM_CONAN_STAGE_STORE", \
+        os.path.join(self._llvm_cache_root, "stages"))
+
+    def _hash_file(self, path):
+      sha = hashlib.sha256()
+      with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+          sha.update(chunk)
+      return sha.hexdigest()
+
+    def _git_revision(self, path):
+      try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], \
+          cwd=path, stderr=subprocess.DEVNULL).decode().strip()
+      except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    @property
+    def _patch_hashes(self):
+      patches_dir = os.path.join(self.source_folder, "patches")
+      if not os.path.exists(patches_dir):
+        return {}
+      return {patch: self._hash_file(os.path.join(patches_dir, patch)) \
+        for patch in sorted(os.listdir(patches_dir))}
+
+    # Replaces folders that differ between package ids and recipe revisions
+    # i.e. same stage inputs must produce same fingerprint.
+    def _normalize_definition(self, value):
+      value = fingerprint_ignored_flags.sub("", str(value))
+      for folder, placeholder in [(self.package_folder, "<package_folder>"), \
+                                  (self.build_folder, "<build_folder>"), \
+                                  (self.source_folder, "<source_folder>")]:
+        if folder:
+          value = value.replace(folder, placeholder)
+      return value
+
+    # Fingerprint of all stage inputs:
+    # source commit, applied patches, cmake definitions
+    # (including LLVM_ENABLE_PROJECTS and LLVM_ENABLE_RUNTIMES), compiler
+    # and fingerprints of stages that produced tools used by stage.
+    def _stage_fingerprint(self, stage, cmake, depends_on=None, extra=None):
+      depends_on = depends_on or []
+      extra = extra or {}
+      inputs = {
+        "stage": stage,
+        "stage_store_version": stage_store_version,
+        "llvm_revision": self._git_revision(self._llvm_source_subfolder),
+        "patches": self._patch_hashes,
+        "definitions": {key: self._normalize_definition(value) \
+          for key, value in cmake.definitions.items() \
+          if key not in fingerprint_ignored_definitions},
+        "compiler": {
+          "name": str(self.settings.compiler),
+          "version": str(self.settings.compiler.version),
+          "libcxx": self._libcxx,
+          "CC": os.getenv("CC", ""),
+          "CXX": os.getenv("CXX", ""),
+        },
+        "depends_on": {dep: self._stage_fingerprints.get(dep, "") \
+          for dep in depends_on},
+        "extra": extra,
+      }
+      fingerprint = hashlib.sha256(\
+        json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+      self._stage_fingerprints[stage] = fingerprint
+      self.output.info('{} fingerprint is {}'.format(stage, fingerprint))
+      return fingerprint
+
+    def _stored_stage_folder(self, stage, fingerprint):
+      return os.path.join(self._stage_store_folder, stage, fingerprint)
+
+    # Stored stage may contain absolute paths to build folder
+    # where stage was built (see lib/cmake/llvm/LLVMExports.cmake),
+    # so we replace them with paths to current build folder.
+    def _relocate_stage(self, stage_folder, old_build_folder, old_source_folder):
+      cmake_dir = os.path.join(stage_folder, "lib", "cmake")
+      paths = [os.path.join(root, name) for root, dirs, files in os.walk(cmake_dir) \
+        for name in files if name.endswith(".cmake")]
+      # see `copy_install_manifest`
+      if os.path.exists(os.path.join(stage_folder, "install_manifest.txt")):
+        paths.append(os.path.join(stage_folder, "install_manifest.txt"))
+      for path in paths:
+        with open(path, 'r', encoding='latin-1') as f:
+          content = f.read()
+        relocated = content.replace(old_build_folder, self.build_folder) \
+                           .replace(old_source_folder, self.source_folder)
+        if relocated != content:
+          with open(path, 'w', encoding='latin-1') as f:
+            f.write(relocated)
+
+    # Checkpoint marks stage folder as complete (built and installed).
+    # Rerun of `conan build` resumes from first stage without valid checkpoint,
+    # see `_restore_stage`.
+    def _stage_checkpoint_path(self, stage_folder):
+      return os.path.join(stage_folder, ".conan_stage_complete")
+
+    # Stages listed in LLVM_CONAN_FORCE_STAGES (or "all")
+    # are rebuilt even if checkpoint is valid or stage is in stage store.
+    def _stage_forced(self, stage):
+      forced = re.split(r'[,;\s]+', os.getenv("LLVM_CONAN_FORCE_STAGES", "").strip())
+      return stage in forced or "all" in forced
+
+    # Glob patterns (relative to stage folder) of outputs that must exist in complete stage.
+    def _stage_checkpoint_outputs(self, stage):
+      if stage == "stage_tmp_compiler":
+        outputs = ["bin/{}".format(tool) for _, tool, _, _, _ in self._stage_tmp_compiler_tools]
+        if self._use_lld:
+          outputs.append("bin/ld.lld")
+        return outputs
+      if stage == "stage_runtime":
+        return ["lib/libc++.*", "lib/libc++abi.*"]
+      if stage == "stage_llvm":
+        outputs = ["lib/cmake/llvm/LLVMConfig.cmake"]
+        if self.resolve_option("clang"):
+          outputs.append("bin/clang")
+        if self.options.dylib:
+          outputs.append("lib/libLLVM*")
+          if self.resolve_option("clang"):
+            outputs.append("lib/libclang-cpp*")
+        if self.options.package_layout == "lean":
+          outputs.append("install_manifest.txt")
+        return outputs
+      if stage == "iwyu":
+        return ["bin/include-what-you-use"]
+      if stage == "stage_pgo":
+        return [os.path.basename(self._stage_pgo_profdata)]
+      return []
+
+    def _stage_checkpoint_valid(self, stage, fingerprint, stage_folder):
+      checkpoint_path = self._stage_checkpoint_path(stage_folder)
+      if not os.path.exists(checkpoint_path):
+        return False
+      with open(checkpoint_path, 'r') as f:
+        checkpoint = json.load(f)
+      if checkpoint.get("fingerprint") != fingerprint:
+        self.output.info('{}: checkpoint has other fingerprint'.format(stage))
+        return False
+      for pattern in self._stage_checkpoint_outputs(stage):
+        if not glob.glob(os.path.join(stage_folder, pattern)):
+          self.output.warn('{}: checkpoint is invalid, missing {}'.format(stage, pattern))
+          return False
+      return True
+
+    def _write_stage_checkpoint(self, stage, fingerprint, stage_folder):
+      outputs = []
+      for pattern in self._stage_checkpoint_outputs(stage):
+        found = glob.glob(os.path.join(stage_folder, pattern))
+        if not found:
+          raise Exception("{}: unable to find {} in {}".format(stage, pattern, stage_folder))
+        outputs.extend(os.path.relpath(path, stage_folder) for path in found)
+      with open(self._stage_checkpoint_path(stage_folder), 'w') as f:
+        json.dump({"fingerprint": fingerprint, "outputs": sorted(outputs)}, f, indent=2)
+
+    # Returns True if stage has valid checkpoint or was restored from stage store
+    # i.e. no need to configure and build stage.
+    def _restore_stage(self, stage, fingerprint, stage_folder):
+      if self._stage_forced(stage):
+        self.output.info('{}: forced rebuild, see LLVM_CONAN_FORCE_STAGES'.format(stage))
+        if os.path.exists(self._stage_checkpoint_path(stage_folder)):
+          os.remove(self._stage_checkpoint_path(stage_folder))
+        return False
+      if self._stage_checkpoint_valid(stage, fingerprint, stage_folder):
+        self.output.info('{}: already complete, skipping (see {})'.format( \
+          stage, self._stage_checkpoint_path(stage_folder)))
+        return True
+      # stage will be rebuilt (or restored), so remove stale checkpoint
+      if os.path.exists(self._stage_checkpoint_path(stage_folder)):
+        os.remove(self._stage_checkpoint_path(stage_folder))
+      if not self._stage_store_enabled:
+        return False
+      stored_folder = self._stored_stage_folder(stage, fingerprint)
+      if not os.path.isdir(stored_folder):
+        self.output.info('{}: not found in stage store'.format(stage))
+        return False
+      self.output.info('{}: restoring from {}'.format(stage, stored_folder))
+      if os.path.exists(stage_folder):
+        shutil.rmtree(stage_folder)
+      shutil.copytree(stored_folder, stage_folder, symlinks=True)
+      metadata_path = os.path.join(stage_folder, ".conan_stage.json")
+      with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+      os.remove(metadata_path)
+      self._relocate_stage(stage_folder, \
+        metadata["build_folder"], metadata["source_folder"])
+      # most recently used stages are kept by `_prune_stage_store`
+      os.utime(stored_folder)
+      self._write_stage_checkpoint(stage, fingerprint, stage_folder)
+      return True
+
+    # Called after successful build (and install) of stage
+    # i.e. also writes checkpoint, see `_stage_checkpoint_valid`.
+    def _store_stage(self, stage, fingerprint, stage_folder):
+      self._write_stage_checkpoint(stage, fingerprint, stage_folder)
+      if not self._stage_store_enabled:
+        return
+      stored_folder = self._stored_stage_folder(stage, fingerprint)
+      if os.path.exists(stored_folder):
+        return
+      self.output.info('{}: storing into {}'.format(stage, stored_folder))
+      # copy into temporary folder and rename it,
+      # so partially stored stage will never be restored
+      tmp_folder = '{}.tmp{}'.format(stored_folder, os.getpid())
+      if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+      # object files are not used by next stages or by package()
+      # NOTE: `.conan_configure.json` is not stored,
+      # so stage restored into other build folder will be reconfigured if needed
+      shutil.copytree(stage_folder, tmp_folder, symlinks=True, \
+        ignore=shutil.ignore_patterns('CMakeFiles', '*.o', '*.obj', '.conan_configure.json', \
+                                      '.conan_stage_complete'))
+      with open(os.path.join(tmp_folder, ".conan_stage.json"), 'w') as f:
+        json.dump({"build_folder": self.build_folder, \
+                   "source_folder": self.source_folder}, f)
+      os.rename(tmp_folder, stored_folder)
+      self._prune_stage_store(stage)
+
+    def _prune_stage_store(self, stage):
+      keep = int(os.getenv("LLVM_CONAN_STAGE_STORE_KEEP", "2"))
+      stage_store = os.path.join(self._stage_store_folder, stage)
+      stored_folders = [os.path.join(stage_store, item) \
+        for item in os.listdir(stage_store) if not ".tmp" in item]
+      stored_folders.sort(key=os.path.getmtime, reverse=True)
+      for stored_folder in stored_folders[keep:]:
+        self.output.info('{}: pruning {}'.format(stage, stored_folder))
+        shutil.rmtree(stored_folder, ignore_errors=True)
 
     # stage_tmp_compiler: build compiler to re-build other code.
     # * Force static linking
@@ -964,13 +2570,9 @@ class LLVM9Conan(ConanFile):
           # clang from stage_tmp_compiler required for next stages (it will be used to compile code)
           raise ConanInvalidConfiguration("enable project clang for stage_tmp_compiler")
 
-        # useful if you run `conan build` multiple times during development
-        if os.path.exists("CMakeCache.txt"):
-          os.remove("CMakeCache.txt")
-          self.output.info("removed CMakeCache.txt")
-
         # NOTE: builds `libcxx;libcxxabi` separately (for sanitizers support)
         cmake = self._configure_cmake(\
+            stage = "stage_tmp_compiler", \
             llvm_enable_projects = ';'.join(self._stage_tmp_compiler_llvm_projects), \
             llvm_runtimes = ';'.join(self._stage_tmp_compiler_llvm_runtimes), \
         )
@@ -980,6 +2582,9 @@ class LLVM9Conan(ConanFile):
         cmake.definitions["SHARED_LIBS"]="OFF"
         cmake.definitions["SHARED"]="OFF"
 
+        self.use_compiler_cache(cmake, "stage_tmp_compiler")
+        self.use_build_timing(cmake, "stage_tmp_compiler", self._stage_tmp_compiler_folder)
+
         # see lld in LLVM_ENABLE_PROJECTS
         # This option is equivalent to -DLLVM_USE_LINKER=lld,
         # except during a 2-stage build where a dependency
@@ -990,12 +2595,19 @@ class LLVM9Conan(ConanFile):
         llvm_src_dir = os.path.join(self._llvm_source_subfolder, "llvm")
         self.output.info('llvm_src_dir is {}'.format(llvm_src_dir))
 
-        # The CMakeLists.txt file must be in `source_folder`
-        cmake.configure(source_folder=llvm_src_dir, build_folder=self._stage_tmp_compiler_folder)
+        fingerprint = self._stage_fingerprint("stage_tmp_compiler", cmake, \
+          extra = {"targets": self._stage_tmp_compiler_targets})
+        restored = self._restore_stage("stage_tmp_compiler", fingerprint, \
+          self._stage_tmp_compiler_folder)
 
-        # see https://fuchsia.googlesource.com/fuchsia/+/HEAD/docs/development/build/toolchain.md
-        # -j flag for parallel builds
-        cmake.build(args=["--", "-j%s" % self._fit_cpu_count])
+        if not restored:
+          # The CMakeLists.txt file must be in `source_folder`
+          self._cmake_configure(cmake, "stage_tmp_compiler", llvm_src_dir, self._stage_tmp_compiler_folder)
+
+          # see https://fuchsia.googlesource.com/fuchsia/+/HEAD/docs/development/build/toolchain.md
+          self._cmake_build(cmake, "stage_tmp_compiler", target=self._stage_tmp_compiler_targets)
+          self._collect_compiler_cache_stats("stage_tmp_compiler")
+          self._analyze_build_log("stage_tmp_compiler", self._stage_tmp_compiler_folder)
 
         # NOTE: No install for stage_tmp_compiler
         # cmake.install()
@@ -1005,6 +2617,9 @@ class LLVM9Conan(ConanFile):
         if not os.path.exists(llvm_clang):
             raise Exception("ERROR: Unable to find path: {}".format(llvm_clang))
 
+        if not restored:
+          self._store_stage("stage_tmp_compiler", fingerprint, self._stage_tmp_compiler_folder)
+
     # NOTE: iwyu version must match LLVM and clang headers version
     # NOTE: iwyu depends on LLVM libs i.e. LLVMCore, LLVMSupport, etc.
     # NOTE: iwyu depends on clang libs i.e. clangFrontend, clangSerialization, etc.
@@ -1022,11 +2637,6 @@ class LLVM9Conan(ConanFile):
 
         # with tools.chdir(self._iwyu_source_subfolder):
 
-        # useful if you run `conan build` multiple times during development
-        if os.path.exists("CMakeCache.txt"):
-          os.remove("CMakeCache.txt")
-          self.output.info("removed CMakeCache.txt")
-
         #extraenv = RunEnvironment(self).vars
 
         #if 'clang' in str(self.settings.compiler):
@@ -1037,12 +2647,25 @@ class LLVM9Conan(ConanFile):
 
         #with tools.environment_append(extraenv):
 
-        cmake = CMake(self, set_cmake_flags=True)
-        cmake.verbose = True
+        cmake = self._new_cmake()
 
         if self._stage_tmp_compiler_enabled:
           self.use_stage_tmp_compiler_compiler(cmake)
 
+        self.use_target_cpu_flags(cmake)
+
+        self.use_debug_info_flags(cmake)
+
+        self.use_compiler_cache(cmake, "iwyu")
+        self.use_build_timing(cmake, "iwyu", self._iwyu_folder)
+
+        if self._use_ninja:
+          # IWYU does not use LLVM cmake modules i.e. no LLVM_PARALLEL_LINK_JOBS
+          cmake.definitions["CMAKE_JOB_POOLS"]="compile={};link={}".format( \
+            self._compile_jobs("iwyu"), self._link_jobs("iwyu"))
+          cmake.definitions["CMAKE_JOB_POOL_COMPILE"]="compile"
+          cmake.definitions["CMAKE_JOB_POOL_LINK"]="link"
+
         # see lld in LLVM_ENABLE_PROJECTS
         # This option is equivalent to -DLLVM_USE_LINKER=lld,
         # except during a 2-stage build where a dependency
@@ -1068,13 +2691,22 @@ class LLVM9Conan(ConanFile):
         # must find LLVMConfig.cmake
         cmake.definitions["CMAKE_MODULE_PATH"]="{}/cmake".format(self._stage_llvm_folder)
 
+        fingerprint = self._stage_fingerprint("iwyu", cmake, \
+          depends_on = ["stage_tmp_compiler", "stage_llvm"], \
+          extra = {"iwyu_revision": self._git_revision(self._iwyu_source_subfolder)})
+        if self._restore_stage("iwyu", fingerprint, self._iwyu_folder):
+          return
+
         # The CMakeLists.txt file must be in `source_folder`
-        cmake.configure(source_folder=self._iwyu_source_subfolder, build_folder=self._iwyu_folder)
+        self._cmake_configure(cmake, "iwyu", self._iwyu_source_subfolder, self._iwyu_folder)
 
         # see https://fuchsia.googlesource.com/fuchsia/+/HEAD/docs/development/build/toolchain.md
-        # -j flag for parallel builds
-        cmake.build(args=["--", "-j%s" % self._fit_cpu_count])
-        cmake.install()
+        self._cmake_build(cmake, "iwyu")
+        self._cmake_install(cmake, "iwyu")
+        self._collect_compiler_cache_stats("iwyu")
+        self._analyze_build_log("iwyu", self._iwyu_folder)
+
+        self._store_stage("iwyu", fingerprint, self._iwyu_folder)
 
         # Using the helper attributes cmake.command_line and cmake.build_config
         # because cmake.definitions["CMAKE_PREFIX_PATH"] failed
@@ -1098,6 +2730,28 @@ class LLVM9Conan(ConanFile):
         #     self.run('cmake --build . %s' % (cmake.build_config))
         #     self.run('cmake --build . --target install')
 
+    # Builds stage_runtime variants concurrently, target by target.
+    # NOTE: `tools.environment_append` (also used by `cmake.build` and `self.run`)
+    # replaces whole `os.environ` on exit, so it is not thread-safe.
+    # Processes are started from main thread with their own env. instead.
+    def _build_stage_runtime_variants(self, cmakes, jobs):
+        env = dict(os.environ)
+        env.update(self._compiler_cache_env("stage_runtime"))
+        cmake_program = os.getenv("CONAN_CMAKE_PROGRAM", "cmake")
+        for target in stage_runtime_targets:
+          with self._telemetry("stage_runtime/build:{}".format(target)):
+            processes = []
+            for variant, _ in stage_runtime_variants:
+              command = [cmake_program, "--build", self._stage_runtime_variant_folder(variant)]
+              command.extend(cmakes[variant].build_config.split())
+              command.extend(["--target", target, "--parallel", str(jobs)])
+              self.output.info('stage_runtime ({}): {}'.format(variant, " ".join(command)))
+              processes.append((variant, subprocess.Popen(command, env=env)))
+            failed = [variant for variant, process in processes if process.wait() != 0]
+            if failed:
+              raise Exception("stage_runtime: failed to build {} (variants: {})".format( \
+                target, ", ".join(failed)))
+
     def build_stage_runtime(self):
         self.output.info('stage_runtime')
 
@@ -1106,11 +2760,6 @@ class LLVM9Conan(ConanFile):
 
         self.old_env = dict(os.environ)
 
-        # useful if you run `conan build` multiple times during development
-        if os.path.exists("CMakeCache.txt"):
-          os.remove("CMakeCache.txt")
-          self.output.info("removed CMakeCache.txt")
-
         # We want to enable sanitizers on `libcxx;libcxxabi;compiler-rt`,
         # but NOT on whole LLVM.
         # Sanitizer requires that all program code is instrumented.
@@ -1123,13 +2772,35 @@ class LLVM9Conan(ConanFile):
 
         # Build runtimes separately
         # NOTE: builds `libcxx;libcxxabi` separately (for sanitizers support)
-        cmake = self._configure_cmake( \
-            llvm_enable_projects = ';'.join(self._stage_runtime_llvm_projects), \
-            llvm_runtimes = ';'.join(self._stage_runtime_llvm_runtimes), \
-            llvm_sanitizer=llvm_sanitizer_key)
-
-        if self._stage_tmp_compiler_enabled:
-          self.use_stage_tmp_compiler_compiler(cmake)
+        cmakes = {}
+        for variant, shared in stage_runtime_variants:
+          cmake = self._configure_cmake( \
+              stage = "stage_runtime", \
+              llvm_enable_projects = ';'.join(self._stage_runtime_llvm_projects), \
+              llvm_runtimes = ';'.join(self._stage_runtime_llvm_runtimes), \
+              llvm_sanitizer=llvm_sanitizer_key)
+
+          if self._stage_tmp_compiler_enabled:
+            self.use_stage_tmp_compiler_compiler(cmake)
+
+          # NOTE: builds both static and shared runtime libraries
+          cmake.definitions["BUILD_SHARED_LIBS"]=shared
+          cmake.definitions["SHARED_LIBS"]=shared
+          cmake.definitions["SHARED"]=shared
+
+          # all variants install into same prefix
+          cmake.definitions["CMAKE_INSTALL_PREFIX"]=self._stage_runtime_folder
+
+          # variants are built concurrently i.e. share job budget
+          cmake.definitions["LLVM_PARALLEL_COMPILE_JOBS"]=\
+            str(self._stage_runtime_variant_jobs(self._compile_jobs("stage_runtime")))
+          cmake.definitions["LLVM_PARALLEL_LINK_JOBS"]=\
+            str(self._stage_runtime_variant_jobs(self._link_jobs("stage_runtime")))
+
+          self.use_compiler_cache(cmake, "stage_runtime")
+          self.use_build_timing(cmake, "stage_runtime_{}".format(variant), \
+            self._stage_runtime_variant_folder(variant))
+          cmakes[variant] = cmake
 
         # LLVM_TOOLCHAIN_TOOLS = "dsymutil;llc;opt;llvm-ar;llvm-ranlib;llvm-lib;llvm-nm;llvm-objcopy;llvm-objdump;llvm-rc;llvm-profdata;llvm-symbolizer"
 
@@ -1157,50 +2828,171 @@ class LLVM9Conan(ConanFile):
         llvm_src_dir = os.path.join(self._llvm_source_subfolder, "llvm")
         self.output.info('llvm_src_dir is {}'.format(llvm_src_dir))
 
-        # NOTE: builds both static and shared runtime libraries
-        cmake.definitions["BUILD_SHARED_LIBS"]="ON"
-        cmake.definitions["SHARED_LIBS"]="ON"
-        cmake.definitions["SHARED"]="ON"
+        fingerprint = self._stage_fingerprint("stage_runtime", cmakes["shared"], \
+          depends_on = ["stage_tmp_compiler"], \
+          extra = {"variants": [variant for variant, _ in stage_runtime_variants], \
+                   "targets": stage_runtime_targets})
+        if self._restore_stage("stage_runtime", fingerprint, self._stage_runtime_folder):
+          os.environ.clear()
+          os.environ.update(self.old_env)
+          return
 
-        # The CMakeLists.txt file must be in `source_folder`
-        cmake.configure(source_folder=llvm_src_dir, build_folder=self._stage_runtime_folder)
+        # NOTE: configure changes current directory of process,
+        # so configure variants one by one.
+        for variant, _ in stage_runtime_variants:
+          # The CMakeLists.txt file must be in `source_folder`
+          self._cmake_configure(cmakes[variant], "stage_runtime", llvm_src_dir, \
+            self._stage_runtime_variant_folder(variant))
 
         # We assume that no one need recipe with whole LLVM codebase sanitized
         # but a lot of people may want to have sanitized libc++ and libc++abi
         # https://github.com/awslabs/amazon-kinesis-video-streams-webrtc-sdk-c/blob/master/.github/msan-tester.Dockerfile
-        cmake.build(args=["--", "cxx", "cxxabi", "-j%s" % self._fit_cpu_count])
-        cmake.install(args=["--", "cxx", "cxxabi"])
+        jobs = self._stage_runtime_variant_jobs(self._compile_jobs("stage_runtime"))
+        self._build_stage_runtime_variants(cmakes, jobs)
 
-        # NOTE: builds both static and shared runtime libraries
-        cmake.definitions["BUILD_SHARED_LIBS"]="OFF"
-        cmake.definitions["SHARED_LIBS"]="OFF"
-        cmake.definitions["SHARED"]="OFF"
+        # install only `libcxx;libcxxabi` components
+        # NOTE: variants install same headers, so install variants one by one.
+        for variant, _ in stage_runtime_variants:
+          for target in stage_runtime_targets:
+            self._cmake_build(cmakes[variant], "stage_runtime", target="install-{}".format(target))
 
-        # The CMakeLists.txt file must be in `source_folder`
-        cmake.configure(source_folder=llvm_src_dir, build_folder=self._stage_runtime_folder)
+        self._collect_compiler_cache_stats("stage_runtime")
+        for variant, _ in stage_runtime_variants:
+          self._analyze_build_log("stage_runtime_{}".format(variant), \
+            self._stage_runtime_variant_folder(variant), jobs=jobs)
 
-        # We assume that no one need recipe with whole LLVM codebase sanitized
-        # but a lot of people may want to have sanitized libc++ and libc++abi
-        # https://github.com/awslabs/amazon-kinesis-video-streams-webrtc-sdk-c/blob/master/.github/msan-tester.Dockerfile
-        cmake.build(args=["--", "cxx", "cxxabi", "-j%s" % self._fit_cpu_count])
-        cmake.install(args=["--", "cxx", "cxxabi"])
+        self._store_stage("stage_runtime", fingerprint, self._stage_runtime_folder)
 
         os.environ.clear()
         os.environ.update(self.old_env)
 
+    # Compiles training corpus (C/C++ files) with instrumented clang.
+    def _pgo_training_sources(self, corpus):
+        sources = []
+        for root, dirs, files in os.walk(corpus):
+          sources.extend(os.path.join(root, name) for name in files \
+            if os.path.splitext(name)[1] in [".c", ".cc", ".cpp", ".cxx"])
+        return sorted(sources)
+
+    # Same as `_patch_hashes`: edited corpus must invalidate stored profile.
+    def _pgo_corpus_hashes(self, corpus):
+      return {os.path.relpath(source, corpus).replace(os.sep, "/"): self._hash_file(source) \
+        for source in self._pgo_training_sources(corpus)}
+
+    def _run_pgo_training_corpus(self, corpus, clang):
+        sources = self._pgo_training_sources(corpus)
+        if not sources:
+          raise Exception("Unable to find C/C++ files in {}".format(corpus))
+        flags = os.getenv("LLVM_CONAN_PGO_TRAINING_FLAGS", "-O2").split()
+        self.output.info('stage_pgo: compiling {} files from {}'.format(len(sources), corpus))
+        def compile_source(source):
+          # NOTE: failed compilations produce profile too
+          return subprocess.call([clang + ("" if source.endswith(".c") else "++")] \
+            + flags + ["-c", source, "-o", os.devnull])
+        with ThreadPoolExecutor(max_workers=self._compile_jobs("stage_pgo")) as executor:
+          failed = sum(1 for returncode in executor.map(compile_source, sources) if returncode)
+        if failed:
+          self.output.warn('stage_pgo: {} of {} training files failed to compile'.format( \
+            failed, len(sources)))
+
+    # Builds instrumented clang, runs training workload with it
+    # and merges collected profiles into `_stage_pgo_profdata`.
+    def build_stage_pgo(self):
+        self.output.info('stage_pgo')
+
+        if not self.options.pgo:
+          return
+
+        instrumented_folder = '{}/stage_pgo_instrumented'.format(self.build_folder)
+        training_folder = '{}/stage_pgo_training'.format(self.build_folder)
+        profiles_folder = '{}/profiles'.format(training_folder)
+        for folder in [self._stage_pgo_folder, instrumented_folder]:
+          if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        cmake = self._configure_cmake( \
+            stage = "stage_pgo", \
+            llvm_enable_projects = "clang", \
+            llvm_runtimes = "", \
+        )
+        self.use_stage_tmp_compiler_compiler(cmake)
+        self.use_compiler_cache(cmake, "stage_pgo")
+        self.use_build_timing(cmake, "stage_pgo", instrumented_folder)
+
+        # see https://llvm.org/docs/HowToBuildWithPGO.html
+        cmake.definitions["LLVM_BUILD_INSTRUMENTED"]="IR"
+        cmake.definitions["LLVM_BUILD_RUNTIME"]="OFF"
+        cmake.definitions["LLVM_PROFILE_DATA_DIR"]=profiles_folder
+        # instrumented clang is used only by this stage
+        cmake.definitions["BUILD_SHARED_LIBS"]="OFF"
+
+        corpus = os.getenv("LLVM_CONAN_PGO_TRAINING_CORPUS")
+        training_targets = os.getenv("LLVM_CONAN_PGO_TRAINING_TARGETS", ";".join(pgo_training_targets))
+        fingerprint = self._stage_fingerprint("stage_pgo", cmake, \
+          depends_on = ["stage_tmp_compiler"], \
+          extra = {"training_corpus": corpus, \
+                   "training_corpus_hashes": self._pgo_corpus_hashes(corpus) if corpus else None, \
+                   "training_flags": os.getenv("LLVM_CONAN_PGO_TRAINING_FLAGS", "-O2"), \
+                   "training_targets": None if corpus else training_targets})
+        if self._restore_stage("stage_pgo", fingerprint, self._stage_pgo_folder):
+          return
+
+        llvm_src_dir = os.path.join(self._llvm_source_subfolder, "llvm")
+        self._cmake_configure(cmake, "stage_pgo", llvm_src_dir, instrumented_folder)
+        self._cmake_build(cmake, "stage_pgo", target="clang")
+        self._collect_compiler_cache_stats("stage_pgo")
+        self._analyze_build_log("stage_pgo", instrumented_folder)
+
+        instrumented_clang = "{}/bin/clang".format(instrumented_folder)
+        if not os.path.exists(instrumented_clang):
+            raise Exception("ERROR: Unable to find path: {}".format(instrumented_clang))
+
+        # profiles of previous training runs are stale
+        if os.path.exists(training_folder):
+          shutil.rmtree(training_folder)
+        os.makedirs(profiles_folder)
+
+        # `%Nm` merges profiles of all clang processes online into N files
+        profile_env = {"LLVM_PROFILE_FILE": os.path.join(profiles_folder, "clang-%8m.profraw")}
+        with self._telemetry("stage_pgo/training"), tools.environment_append(profile_env):
+          if corpus:
+            self._run_pgo_training_corpus(corpus, instrumented_clang)
+          else:
+            # compile slice of LLVM sources with instrumented clang
+            # NOTE: no compiler cache, cache hits would not run clang
+            training_cmake = self._configure_cmake( \
+                stage = "stage_pgo", \
+                llvm_enable_projects = "", \
+                llvm_runtimes = "", \
+            )
+            self.use_stage_tmp_compiler_compiler(training_cmake)
+            training_cmake.definitions["CMAKE_C_COMPILER"]=instrumented_clang
+            training_cmake.definitions["CMAKE_CXX_COMPILER"]="{}++".format(instrumented_clang)
+            self._cmake_configure(training_cmake, "stage_pgo", llvm_src_dir, training_folder)
+            for target in training_targets.split(";"):
+              self._cmake_build(training_cmake, "stage_pgo", target=target)
+
+        profiles = glob.glob(os.path.join(profiles_folder, "*.profraw"))
+        if not profiles:
+          raise Exception("ERROR: training produced no profiles in {}".format(profiles_folder))
+
+        llvm_profdata = "{}/bin/llvm-profdata".format(self._stage_tmp_compiler_folder)
+        if not os.path.exists(llvm_profdata):
+            raise Exception("ERROR: Unable to find path: {}".format(llvm_profdata))
+        self.run('"{}" merge -output="{}" {}'.format(llvm_profdata, self._stage_pgo_profdata, \
+          " ".join('"{}"'.format(profile) for profile in profiles)))
+
+        self._store_stage("stage_pgo", fingerprint, self._stage_pgo_folder)
+
     def build_stage_llvm(self):
         self.output.info('stage_llvm')
 
         if not os.path.exists(self._stage_llvm_folder):
             os.makedirs(self._stage_llvm_folder)
 
-        # useful if you run `conan build` multiple times during development
-        if os.path.exists("CMakeCache.txt"):
-          os.remove("CMakeCache.txt")
-          self.output.info("removed CMakeCache.txt")
-
         # NOTE: builds `libcxx;libcxxabi` separately (for sanitizers support)
         cmake = self._configure_cmake(\
+            stage = "stage_llvm", \
             llvm_enable_projects = ';'.join(self._stage_llvm_llvm_projects), \
             llvm_runtimes = ';'.join(self._stage_llvm_llvm_runtimes), \
         )
@@ -1208,6 +3000,25 @@ class LLVM9Conan(ConanFile):
         if self._stage_tmp_compiler_enabled:
           self.use_stage_tmp_compiler_compiler(cmake)
 
+        self.use_target_cpu_flags(cmake, excluded_projects = \
+          [project for project in target_cpu_excluded_projects \
+           if project in self._stage_llvm_llvm_projects])
+
+        if self.options.dylib:
+          # NOTE: static component libraries (libLLVMCore.a, etc.) are still built
+          cmake.definitions["BUILD_SHARED_LIBS"]="OFF"
+          cmake.definitions["LLVM_BUILD_LLVM_DYLIB"]="ON"
+          cmake.definitions["LLVM_LINK_LLVM_DYLIB"]="ON"
+          cmake.definitions["CLANG_LINK_CLANG_DYLIB"]="ON" if self.resolve_option("clang") else "OFF"
+
+        if self.options.package_layout == "lean":
+          # install into stage folder, so install tree is kept by stage store
+          # and package() can copy only installed files
+          cmake.definitions["CMAKE_INSTALL_PREFIX"]=self._stage_llvm_install_folder
+
+        self.use_compiler_cache(cmake, "stage_llvm")
+        self.use_build_timing(cmake, "stage_llvm", self._stage_llvm_folder)
+
         # see lld in LLVM_ENABLE_PROJECTS
         # This option is equivalent to -DLLVM_USE_LINKER=lld,
         # except during a 2-stage build where a dependency
@@ -1217,13 +3028,30 @@ class LLVM9Conan(ConanFile):
 
         llvm_src_dir = os.path.join(self._llvm_source_subfolder, "llvm")
         self.output.info('llvm_src_dir is {}'.format(llvm_src_dir))
+
+        depends_on = ["stage_tmp_compiler"]
+        if self.options.pgo:
+          # see `build_stage_pgo`
+          cmake.definitions["LLVM_PROFDATA_FILE"]=self._stage_pgo_profdata
+          depends_on.append("stage_pgo")
+
+        # NOTE: restored stage skips `cmake.install()`,
+        # package() copies files from stage_llvm folder anyway.
+        fingerprint = self._stage_fingerprint("stage_llvm", cmake, \
+          depends_on = depends_on)
+        if self._restore_stage("stage_llvm", fingerprint, self._stage_llvm_folder):
+          return
+
         # The CMakeLists.txt file must be in `source_folder`
-        cmake.configure(source_folder=llvm_src_dir, build_folder=self._stage_llvm_folder)
+        self._cmake_configure(cmake, "stage_llvm", llvm_src_dir, self._stage_llvm_folder)
 
         # see https://fuchsia.googlesource.com/fuchsia/+/HEAD/docs/development/build/toolchain.md
-        # -j flag for parallel builds
-        cmake.build(args=["--", "-j%s" % self._fit_cpu_count])
-        cmake.install()
+        self._cmake_build(cmake, "stage_llvm")
+        self._cmake_install(cmake, "stage_llvm")
+        self._collect_compiler_cache_stats("stage_llvm")
+        self._analyze_build_log("stage_llvm", self._stage_llvm_folder)
+
+        self._store_stage("stage_llvm", fingerprint, self._stage_llvm_folder)
 
     def _supports_compiler(self):
         compiler = self.settings.compiler.value
@@ -1296,35 +3124,141 @@ class LLVM9Conan(ConanFile):
         if self.options.include_what_you_use and self._has_sanitizers:
             raise ConanInvalidConfiguration("disable include_what_you_use when sanitizers enabled")
 
+        if self.options.dylib and self.options.shared:
+            raise ConanInvalidConfiguration("dylib can not be used with shared=True (BUILD_SHARED_LIBS), set shared=False")
+
+        if (self.options.split_dwarf or self.options.compress_debug_sections) and not self.options.debug_info:
+            raise ConanInvalidConfiguration("split_dwarf and compress_debug_sections require debug_info=True")
+
+        if self.options.compress_debug_sections and not self.options.libz:
+            raise ConanInvalidConfiguration("compress_debug_sections requires libz=True (zlib support in packaged tools)")
+
+        if self.options.package_part == "devel" and not self.options.link_with_llvm_libs:
+            raise ConanInvalidConfiguration("package_part=devel requires link_with_llvm_libs=True")
+
+        if "native" in [self._march, self._mtune]:
+            # package_id() runs on consumer machines too
+            raise ConanInvalidConfiguration("march=native and mtune=native depend on build machine, " \
+              "set CPU explicitly (i.e. `-o llvm_9:march=skylake`, see `clang -march=native -###`)")
+
+        if self.options.pgo and not self._stage_tmp_compiler_enabled:
+            raise ConanInvalidConfiguration("pgo requires stage_tmp_compiler (instrumented clang needs profile runtime)")
+
+        if self.options.pgo and not self.resolve_option("clang"):
+            raise ConanInvalidConfiguration("pgo optimizes clang, enable project clang")
+
     def requirements(self):
         self.output.info('self.settings.compiler {}'.format(self.settings.compiler))
 
+    # Top-level folders of llvm-project required by enabled stages.
+    @property
+    def _sparse_checkout_paths(self):
+        projects = set(self._stage_runtime_llvm_projects + self._stage_llvm_llvm_projects)
+        if self._stage_tmp_compiler_enabled:
+          projects.update(self._stage_tmp_compiler_llvm_projects)
+        return ["llvm"] + sorted(projects)
+
+    # Clones `branch` of `url` into `folder`.
+    # `mirror_env` - env. var. that can point to local (bare) mirror of `url`.
+    # LLVM_CONAN_GIT_REFERENCE - local repository used as `--reference`
+    #   (objects are copied with `--dissociate`, so reference can be removed later).
+    # LLVM_CONAN_GIT_DEPTH - history depth, "0" means full history.
+    # `sparse_paths` - if set, checkout only listed top-level folders.
+    def _git_clone(self, url, mirror_env, branch, folder, sparse_paths=None):
+        url = os.getenv(mirror_env, url)
+        args = ['git', 'clone', '-b', branch, '--single-branch', '--progress']
+        depth = int(os.getenv("LLVM_CONAN_GIT_DEPTH", "100"))
+        if depth > 0:
+          # NOTE: --depth is ignored for local paths without file://
+          args.extend(['--depth', str(depth)])
+          if os.path.isdir(url):
+            url = 'file://{}'.format(os.path.abspath(url))
+        reference = os.getenv("LLVM_CONAN_GIT_REFERENCE")
+        if reference:
+          args.extend(['--reference-if-able', reference, '--dissociate'])
+        if sparse_paths:
+          args.append('--no-checkout')
+        else:
+          args.extend(['--recursive', '--recurse-submodules'])
+        args.extend([url, folder])
+        self.output.info('cloning {} into {}'.format(url, folder))
+        self.run(subprocess.list2cmdline(args))
+
+        if sparse_paths:
+          # NOTE: `core.sparseCheckout` instead of `git sparse-checkout`,
+          # so older git versions are supported
+          self.output.info('sparse checkout of {}'.format(', '.join(sparse_paths)))
+          self.run('git -C {} config core.sparseCheckout true'.format(folder))
+          with open(os.path.join(folder, '.git', 'info', 'sparse-checkout'), 'w') as f:
+            for path in sparse_paths:
+              f.write('/{}/\n'.format(path))
+          self.run('git -C {} checkout {}'.format(folder, branch))
+          self.run('git -C {} submodule update --init --recursive'.format(folder))
+
+    # NOTE: LLVM_CONAN_SPARSE_CHECKOUT makes source folder depend on options
+    # (`with_<project>`), same as IWYU clone depends on `include_what_you_use`.
     def source(self):
+        sparse_paths = None
+        if self.flag_to_cmake(os.getenv("LLVM_CONAN_SPARSE_CHECKOUT", "OFF")) == "ON":
+          sparse_paths = self._sparse_checkout_paths
+
         # LLVM
-        self.run('git clone -b {} --progress --depth 100 --recursive --recurse-submodules {} {}'.format(self.llvm_version, self.llvm_repo_url, self._llvm_source_subfolder))
+        self._git_clone(self.llvm_repo_url, "LLVM_CONAN_LLVM_MIRROR", \
+          self.llvm_version, self._llvm_source_subfolder, sparse_paths)
 
         # IWYU
         if self.options.include_what_you_use:
-            self.run('git clone -b {} --progress --depth 100 --recursive --recurse-submodules {} {}'.format(self.iwyu_version, self.iwyu_repo_url, self._iwyu_source_subfolder))
+            self._git_clone(self.iwyu_repo_url, "LLVM_CONAN_IWYU_MIRROR", \
+              self.iwyu_version, self._iwyu_source_subfolder)
+
+    @property
+    def _patches_stamp_path(self):
+        return os.path.join(self._llvm_source_subfolder, ".conan_patches.json")
+
+    # Applies patches from `patches/` only once per source tree.
+    # Applied patches and their hashes are stored in stamp file,
+    # so next calls do not touch patched files
+    # (changed mtime forces make/ninja and compiler cache to recompile them).
+    def _apply_patches(self):
+        if os.getenv("CONAN_LLVM_SKIP_PATCH"):
+          return
+
+        compiler_rt_src_dir = os.path.join(self._llvm_source_subfolder, "compiler-rt")
+        self.output.info('compiler_rt_src_dir is {}'.format(compiler_rt_src_dir))
+        if not os.path.exists(compiler_rt_src_dir):
+          # i.e. compiler-rt excluded by LLVM_CONAN_SPARSE_CHECKOUT
+          self.output.info('skipped patches: {} not found'.format(compiler_rt_src_dir))
+          return
+
+        applied_patches = {}
+        if os.path.exists(self._patches_stamp_path):
+          with open(self._patches_stamp_path, 'r') as f:
+            applied_patches = json.load(f)
+
+        for patch, patch_hash in self._patch_hashes.items():
+          if applied_patches.get(patch) == patch_hash:
+            self.output.info('patch {} already applied'.format(patch))
+            continue
+          if patch in applied_patches:
+            raise Exception("patch {} changed after it was applied to {}. Re-create source folder or set CONAN_LLVM_SKIP_PATCH".format(patch, self._llvm_source_subfolder))
+          patchpath = os.path.join(self.source_folder, "patches", patch)
+          self.output.info('patch is {}'.format(patchpath))
+          tools.patch(base_path=compiler_rt_src_dir, patch_file=patchpath)
+          applied_patches[patch] = patch_hash
+          # update stamp after each patch, so failed patch can be retried
+          with open(self._patches_stamp_path, 'w') as f:
+            json.dump(applied_patches, f, indent=2, sort_keys=True)
 
     # see https://releases.llvm.org/9.0.1/docs/CMake.html
-    def _configure_cmake(self, llvm_enable_projects, llvm_runtimes, llvm_sanitizer="None"):
-        self.output.info('configuring LLVM')
+    def _configure_cmake(self, stage, llvm_enable_projects, llvm_runtimes, llvm_sanitizer="None"):
+        self.output.info('configuring LLVM for {}'.format(stage))
 
         llvm_src_dir = os.path.join(self._llvm_source_subfolder, "llvm")
         self.output.info('llvm_src_dir is {}'.format(llvm_src_dir))
 
-        compiler_rt_src_dir = os.path.join(self._llvm_source_subfolder, "compiler-rt")
-        self.output.info('compiler_rt_src_dir is {}'.format(compiler_rt_src_dir))
+        self._apply_patches()
 
-        if not os.getenv("CONAN_LLVM_SKIP_PATCH"):
-          for patch in os.listdir(os.path.join(self.source_folder, "patches")):
-              patchpath = os.path.join(self.source_folder, "patches", patch)
-              self.output.info('patch is {}'.format(patchpath))
-              tools.patch(base_path=compiler_rt_src_dir, patch_file=patchpath)
-
-        cmake = CMake(self, set_cmake_flags=True)
-        cmake.verbose = True
+        cmake = self._new_cmake()
 
         # https://bugs.llvm.org/show_bug.cgi?id=44074
         # cmake.definitions["EXECUTION_ENGINE_USE_LLVM_UNWINDER"]="ON"
@@ -1339,8 +3273,7 @@ class LLVM9Conan(ConanFile):
         cmake.definitions["LLVM_ENABLE_PROJECTS"]=llvm_enable_projects
 
         # see Building LLVM with CMake https://llvm.org/docs/CMake.html
-        cmake.definitions["LLVM_PARALLEL_COMPILE_JOBS"]=\
-          self.flag_to_cmake(os.getenv("LLVM_PARALLEL_COMPILE_JOBS", str(self._fit_cpu_count)))
+        cmake.definitions["LLVM_PARALLEL_COMPILE_JOBS"]=str(self._compile_jobs(stage))
 
         # Microsoft Visual C++ specific
         # Specifies the maximum number of parallel compiler jobs
@@ -1348,16 +3281,18 @@ class LLVM9Conan(ConanFile):
         # Only supported for the Visual Studio 2010 CMake generator.
         # 0 means use all processors. Default is 0.
         cmake.definitions["LLVM_COMPILER_JOBS"]=\
-          self.flag_to_cmake(os.getenv("LLVM_COMPILER_JOBS", str(self._fit_cpu_count)))
+          os.getenv("LLVM_COMPILER_JOBS", str(self._compile_jobs(stage)))
 
-        cmake.definitions["LLVM_PARALLEL_LINK_JOBS"]=\
-          self.flag_to_cmake(os.getenv("LLVM_PARALLEL_LINK_JOBS", "1"))
+        cmake.definitions["LLVM_PARALLEL_LINK_JOBS"]=str(self._link_jobs(stage))
 
-        # TODO: make customizable
         # This should speed up building debug builds
         # see https://www.productive-cpp.com/improving-cpp-builds-with-split-dwarf/
+        # NOTE: LLVM_USE_SPLIT_DWARF affects only Debug and RelWithDebInfo builds,
+        # `use_debug_info_flags` adds `-gsplit-dwarf` (see `split_dwarf` option).
         #cmake.definitions["LLVM_USE_SPLIT_DWARF"]="ON"
 
+        self.use_debug_info_flags(cmake)
+
         # force Release build
         #cmake.definitions["CMAKE_BUILD_TYPE"]="Release"
 
@@ -1460,6 +3395,9 @@ class LLVM9Conan(ConanFile):
 
         cmake.definitions['LLVM_ENABLE_LTO'] = self.options.lto
 
+        if self.options.lto == "Thin":
+          self.use_thinlto_cache(cmake, stage)
+
         cmake.definitions["LLVM_ENABLE_ZLIB"]="ON" if self.options.libz else "OFF"
 
         # TODO
@@ -1687,11 +3625,33 @@ class LLVM9Conan(ConanFile):
     # See docs https://llvm.org/docs/HowToBuildWithPGO.html
     # Multi-stage example https://android.googlesource.com/toolchain/llvm_android/+/bd22d9779676661ae9571972dcd744c42c70ffd0/build.py
     def build(self):
-        if self._stage_tmp_compiler_enabled:
-          self.build_stage_tmp_compiler()
-        self.build_stage_runtime()
-        self.build_stage_llvm()
-        self.build_iwyu()
+        # see `_stage_fingerprint`
+        self._stage_fingerprints = {}
+        # see `_collect_compiler_cache_stats`
+        self._compiler_cache_stats = {}
+        # see `_analyze_build_log`
+        self._build_analysis = {}
+        self._build_log_offsets = {}
+
+        try:
+          if self._stage_tmp_compiler_enabled:
+            with self._telemetry("stage_tmp_compiler", folder=self._stage_tmp_compiler_folder):
+              self.build_stage_tmp_compiler()
+          with self._telemetry("stage_runtime", folder=self._stage_runtime_folder):
+            self.build_stage_runtime()
+          if self.options.pgo:
+            with self._telemetry("stage_pgo", folder=self._stage_pgo_folder):
+              self.build_stage_pgo()
+          with self._telemetry("stage_llvm", folder=self._stage_llvm_folder):
+            self.build_stage_llvm()
+          with self._telemetry("iwyu", folder=self._iwyu_folder):
+            self.build_iwyu()
+        finally:
+          # NOTE: report is useful even if some stage failed (OOM, etc.)
+          self._report_telemetry()
+          self._report_build_analysis()
+
+        self._report_compiler_cache_stats()
 
     def package_iwyu(self):
         package_bin_dir = os.path.join(self.package_folder, "bin")
@@ -1716,6 +3676,50 @@ class LLVM9Conan(ConanFile):
 
       llvm_src_dir = os.path.join(self._llvm_source_subfolder, "llvm")
 
+      if self.options.package_layout == "lean":
+        # copies only headers, libraries, binaries and cmake exports
+        # installed by stage_llvm
+        self.copy_install_manifest( \
+          '{}/install_manifest.txt'.format(self._stage_llvm_folder), \
+          self._stage_llvm_install_folder, \
+          self.package_folder)
+      else:
+        self.package_stage_llvm_full()
+
+      if not os.path.exists(self._stage_runtime_folder):
+          raise Exception("Unable to find path: {}".format(self._stage_runtime_folder))
+
+      if self._has_sanitizers:
+        # Must remove files:
+        # libc++.so, libc++.so.1.0, libc++.so.1
+        # libc++.a
+        # libc++abi.so, libc++abi.so.1.0, libc++abi.so.1
+        # libc++abi.a
+        # libc++experimental.so
+        # libc++experimental.a
+        # etc.
+        # Make sure that stage_runtime will provide that files!
+        fileList = glob.glob('{}/lib/*c++*'.format(self.package_folder), recursive=False)
+        for filePath in fileList:
+          try:
+            self.output.info("removing file %s" % filePath)
+            os.remove(filePath)
+          except:
+            raise Exception("Error while deleting file: {}".format(filePath))
+
+    # Folders copied by `package_layout=full`
+    @property
+    def _package_full_layout_folders(self):
+      return [ \
+        ('{}/bin'.format(self._stage_llvm_folder), 'bin'), \
+        ('{}/include'.format(self._stage_llvm_folder), 'include'), \
+        (os.path.join(self._llvm_source_subfolder, "clang"), 'clang'), \
+        (os.path.join(self._stage_llvm_folder, "tools"), 'tools'), \
+        ('{}/lib'.format(self._stage_llvm_folder), 'lib'), \
+        ('{}/libexec'.format(self._stage_llvm_folder), 'libexec'), \
+      ]
+
+    def package_stage_llvm_full(self):
       self.copytree( \
         '{}/bin'.format(self._stage_llvm_folder), \
         '{}/bin'.format(self.package_folder))
@@ -1726,10 +3730,12 @@ class LLVM9Conan(ConanFile):
         '{}/include'.format(self._stage_llvm_folder), \
         '{}/include'.format(self.package_folder))
 
+      # source tree may be edited in place, so never hardlink it
       clang_src_dir = os.path.join(self._llvm_source_subfolder, "clang")
       self.copytree( \
         '{}'.format(clang_src_dir), \
-        '{}/clang'.format(self.package_folder))
+        '{}/clang'.format(self.package_folder), \
+        hardlinks=False)
 
       tools_src_dir = os.path.join(self._stage_llvm_folder, "tools")
       self.copytree( \
@@ -1746,27 +3752,6 @@ class LLVM9Conan(ConanFile):
         '{}/libexec'.format(self._stage_llvm_folder), \
         '{}/libexec'.format(self.package_folder))
 
-      if not os.path.exists(self._stage_runtime_folder):
-          raise Exception("Unable to find path: {}".format(self._stage_runtime_folder))
-
-      if self._has_sanitizers:
-        # Must remove files:
-        # libc++.so, libc++.so.1.0, libc++.so.1
-        # libc++.a
-        # libc++abi.so, libc++abi.so.1.0, libc++abi.so.1
-        # libc++abi.a
-        # libc++experimental.so
-        # libc++experimental.a
-        # etc.
-        # Make sure that stage_runtime will provide that files!
-        fileList = glob.glob('{}/lib/*c++*'.format(self.package_folder), recursive=False)
-        for filePath in fileList:
-          try:
-            self.output.info("removing file %s" % filePath)
-            os.remove(filePath)
-          except:
-            raise Exception("Error while deleting file: {}".format(filePath))
-
     def package_stage_runtime(self):
       if not os.path.exists(self._stage_runtime_folder):
           raise Exception("Unable to find path: {}".format(self._stage_runtime_folder))
@@ -1826,8 +3811,345 @@ class LLVM9Conan(ConanFile):
         if len(clangrtList) <= 0:
           raise Exception("Unable to find *clang_rt.*asan*")
 
+      self._prune_package_parts()
+
+      if self.options.link_with_llvm_libs and "devel" in self._package_parts:
+        self._write_llvm_components()
+
+      if self.options.split_dwarf:
+        self._package_dwp_files()
+
+      if self.options.split_debug_info:
+        self._split_debug_info()
+
+      self._report_package_size()
+
       self.output.info('packaged for os: %s' % (self.settings.os_build))
 
+    @property
+    def _package_parts(self):
+      if self.options.package_part == "all":
+        return list(package_parts.keys())
+      return [str(self.options.package_part)]
+
+    def _package_part_patterns(self, part):
+      patterns = list(package_parts[part])
+      if part in ["toolchain", "tools"] and (self.options.shared or self.options.dylib):
+        patterns.extend(package_shared_lib_patterns)
+      return patterns
+
+    # Removes files that do not belong to `package_part`.
+    # All parts are packaged from same stage folders,
+    # so parts are pruned after copy.
+    def _prune_package_parts(self):
+      if self.options.package_part == "all":
+        return
+      patterns = []
+      for part in self._package_parts:
+        patterns.extend(self._package_part_patterns(part))
+
+      removed, kept = 0, 0
+      for root, dirs, files in os.walk(self.package_folder, topdown=False):
+        for name in files + [name for name in dirs if os.path.islink(os.path.join(root, name))]:
+          path = os.path.join(root, name)
+          relpath = os.path.relpath(path, self.package_folder).replace(os.sep, '/')
+          if any(fnmatch.fnmatch(relpath, pattern) for pattern in patterns):
+            kept += 1
+            continue
+          os.remove(path)
+          removed += 1
+        if root != self.package_folder and not os.listdir(root):
+          os.rmdir(root)
+      self.output.info('package_part {}: kept {} files, removed {} files'.format( \
+        self.options.package_part, kept, removed))
+
+    # Cached by package() and used by package_info(),
+    # see `_write_llvm_components`.
+    @property
+    def _llvm_components_path(self):
+      return os.path.join(self.package_folder, "llvm_components.json")
+
+    # Returns {target: (type, [INTERFACE_LINK_LIBRARIES])} for library targets.
+    def _parse_cmake_exports(self, path):
+      with open(path, 'r', encoding='latin-1') as f:
+        content = f.read()
+      targets = {name: (kind, []) for name, kind in cmake_export_library_re.findall(content)}
+      for name, properties in cmake_export_properties_re.findall(content):
+        match = cmake_export_link_libraries_re.search(properties)
+        if name in targets and match:
+          targets[name][1].extend(item for item in match.group(1).split(';') if item)
+      return targets
+
+    # Returns ("requires", name), ("system_libs", name) or None
+    # for item of INTERFACE_LINK_LIBRARIES.
+    def _cmake_export_link_item(self, item, targets):
+      match = cmake_export_link_only_re.match(item)
+      if match:
+        item = match.group(1)
+      if item in targets:
+        return ("requires", item)
+      if item.startswith("$<") or "::" in item:
+        # other generator expressions and imported targets
+        return None
+      if item.startswith("-l"):
+        return ("system_libs", item[2:])
+      if item.startswith("-"):
+        return None
+      if os.path.isabs(item):
+        name = re.sub(r'\.(a|so(\.[0-9]+)*|dylib|lib)$', '', os.path.basename(item))
+        return ("system_libs", name[3:] if name.startswith("lib") else name)
+      return ("system_libs", item)
+
+    # Parses installed LLVM and clang cmake exports into
+    # {library: {"requires": [...], "system_libs": [...]}},
+    # so package_info() can emit per-library components with dependencies
+    # instead of flat `llvm_core_libs` and `clang_core_libs` lists.
+    def _write_llvm_components(self):
+      targets = {}
+      for export in cmake_exports:
+        path = os.path.join(self.package_folder, export)
+        if not os.path.exists(path):
+          self.output.warn('Unable to find {}, package_info will use predefined LLVM libs'.format(path))
+          return
+        targets.update(self._parse_cmake_exports(path))
+
+      components = {}
+      for name, (kind, link_libraries) in targets.items():
+        if kind == "INTERFACE":
+          continue
+        component = {"requires": [], "system_libs": []}
+        for item in link_libraries:
+          link_item = self._cmake_export_link_item(item, targets)
+          if link_item and link_item[1] not in component[link_item[0]]:
+            component[link_item[0]].append(link_item[1])
+        components[name] = component
+
+      with open(self._llvm_components_path, 'w') as f:
+        json.dump({"version": llvm_components_version, "components": components}, \
+          f, indent=2, sort_keys=True)
+      self.output.info('LLVM components ({}) written to {}'.format( \
+        len(components), self._llvm_components_path))
+
+    # Returns components written by `_write_llvm_components` or None.
+    def _read_llvm_components(self):
+      if not os.path.exists(self._llvm_components_path):
+        return None
+      try:
+        with open(self._llvm_components_path, 'r') as f:
+          cached = json.load(f)
+      except (OSError, IOError, ValueError):
+        return None
+      if cached.get("version") != llvm_components_version:
+        return None
+      return cached["components"]
+
+    @property
+    def _strip_jobs(self):
+      return int(os.getenv("LLVM_CONAN_STRIP_JOBS", str(self._available_cpu_count)))
+
+    # see `split_debug_info` option
+    @property
+    def _debug_info_folder(self):
+      if self.options.package_debug_info:
+        return self.package_folder
+      return '{}/debug_info'.format(self.build_folder)
+
+    # Prefers tool built by stages, than tool (or one of `fallbacks`) from PATH.
+    def _find_llvm_tool(self, tool, fallbacks=None, required_by=""):
+      fallbacks = fallbacks or []
+      candidates = [ \
+        '{}/bin/{}'.format(self._stage_llvm_folder, tool), \
+        '{}/bin/{}'.format(self._stage_llvm_install_folder, tool), \
+        '{}/bin/{}'.format(self._stage_tmp_compiler_folder, tool), \
+      ]
+      for path in candidates:
+        if os.path.exists(path):
+          return path
+      for name in [tool] + fallbacks:
+        path = tools.which(name)
+        if path:
+          return path
+      raise Exception("Unable to find {} (required by {})".format(tool, required_by))
+
+    # GNU objcopy supports same flags.
+    @property
+    def _llvm_objcopy(self):
+      return self._find_llvm_tool("llvm-objcopy", ["objcopy"], "split_debug_info")
+
+    # Combines `.dwo` files (see `split_dwarf` option) of ELF executables and shared libs
+    # into `<name>.dwp` next to them (gdb looks for it there).
+    # NOTE: `.dwo` files are read from stage build folders,
+    # so stages restored from stage store may have no `.dwo` files.
+    def _package_dwp_files(self):
+      llvm_dwp = self._find_llvm_tool("llvm-dwp", required_by="split_dwarf")
+      # `.dwp` goes to same folder as `.debug` files, see `_split_debug_info`
+      dwp_folder = self._debug_info_folder if self.options.split_debug_info else self.package_folder
+      dwp_path = lambda path: os.path.join(dwp_folder, \
+        os.path.relpath(path, self.package_folder) + ".dwp")
+      groups = self._package_elf_files()
+
+      # hardlinked paths share `.dwp` of first path
+      def package_dwp(paths):
+        dwp_paths = [dwp_path(path) for path in paths]
+        for path in dwp_paths:
+          if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if subprocess.call([llvm_dwp, "-e", paths[0], "-o", dwp_paths[0]], \
+             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+          if os.path.exists(dwp_paths[0]):
+            os.remove(dwp_paths[0])
+          return False
+        if os.path.exists(dwp_paths[0]):
+          for path in dwp_paths[1:]:
+            self._replace_with_link(dwp_paths[0], path)
+        return True
+
+      self.output.info('combining .dwo files of {} files using {} ({} jobs)'.format( \
+        len(groups), llvm_dwp, self._strip_jobs))
+      with ThreadPoolExecutor(max_workers=self._strip_jobs) as executor:
+        packaged = list(executor.map(package_dwp, groups))
+      failed = [paths[0] for paths, ok in zip(groups, packaged) if not ok]
+      if failed:
+        self.output.warn('llvm-dwp failed for {} of {} files (missing .dwo files?), i.e. {}'.format( \
+          len(failed), len(groups), failed[0]))
+
+    # ELF executables and shared libs in package (symlinks are skipped)
+    # grouped by (st_dev, st_ino) i.e. hardlinked paths are in same group.
+    def _package_elf_files(self):
+      groups = {}
+      for root, dirs, files in os.walk(self.package_folder):
+        dirs[:] = [name for name in dirs if name != ".debug"]
+        for name in sorted(files):
+          path = os.path.join(root, name)
+          if os.path.islink(path) or self._elf_type(path) not in [2, 3]:
+            continue
+          path_stat = os.stat(path)
+          groups.setdefault((path_stat.st_dev, path_stat.st_ino), []).append(path)
+      return list(groups.values())
+
+    # Replaces `dst` with hardlink to `src` (copy if hardlink is not possible).
+    def _replace_with_link(self, src, dst):
+      tmp_path = dst + ".conan_tmp"
+      if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+      try:
+        os.link(src, tmp_path)
+      except OSError:
+        shutil.copy2(src, tmp_path)
+      os.replace(tmp_path, dst)
+
+    # Returns ELF type (2 - executable, 3 - shared object) or None.
+    def _elf_type(self, path):
+      try:
+        with open(path, 'rb') as f:
+          header = f.read(18)
+      except (OSError, IOError):
+        return None
+      if len(header) < 18 or header[:4] != b'\x7fELF':
+        return None
+      byteorder = 'little' if header[5] == 1 else 'big'
+      return int.from_bytes(header[16:18], byteorder)
+
+    # Debug info of `<dir>/<name>` is `<dir>/.debug/<name>.debug`,
+    # relative to `_debug_info_folder`.
+    def _debug_info_path(self, path, name):
+      relpath = os.path.relpath(path, self.package_folder)
+      return os.path.join(self._debug_info_folder, \
+        os.path.dirname(relpath), ".debug", name + ".debug")
+
+    # `paths` are hardlinks of same file, all of them are replaced by stripped file.
+    # `.gnu_debuglink` stores name of debug file of first path,
+    # so it is linked into `.debug` folders of other paths.
+    def _split_debug_info_file(self, objcopy, paths):
+      path = paths[0]
+      debug_paths = [self._debug_info_path(other, os.path.basename(path)) for other in paths]
+      debug_path = debug_paths[0]
+      elf_type = self._elf_type(path)
+      strip_flag = "--strip-all" if elf_type == 2 else "--strip-unneeded"
+      for debug_dir in set(os.path.dirname(other) for other in debug_paths):
+        if not os.path.isdir(debug_dir):
+          os.makedirs(debug_dir, exist_ok=True)
+      size = os.path.getsize(path)
+      # NOTE: writes stripped copy and replaces file,
+      # so hardlinked files (see LLVM_CONAN_PACKAGE_LINK_MODE) are not modified in place
+      stripped_path = path + ".stripped"
+      try:
+        subprocess.check_call([objcopy, "--only-keep-debug", path, debug_path])
+        subprocess.check_call([objcopy, strip_flag, \
+          "--add-gnu-debuglink={}".format(debug_path), path, stripped_path])
+        shutil.copymode(path, stripped_path)
+        os.replace(stripped_path, path)
+      except (subprocess.CalledProcessError, OSError):
+        for tmp_path in [stripped_path, debug_path]:
+          if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+      for other, other_debug_path in zip(paths[1:], debug_paths[1:]):
+        self._replace_with_link(path, other)
+        if other_debug_path != debug_path:
+          self._replace_with_link(debug_path, other_debug_path)
+      return size, os.path.getsize(path)
+
+    # Strips ELF executables and shared libs (static libs are kept as is).
+    # Debug info of `<dir>/<name>` is written to `<dir>/.debug/<name>.debug`
+    # (relative to `_debug_info_folder`), gdb looks for it there.
+    def _split_debug_info(self):
+      objcopy = self._llvm_objcopy
+      items = self._package_elf_files()
+
+      self.output.info('splitting debug info of {} files using {} ({} jobs)'.format( \
+        len(items), objcopy, self._strip_jobs))
+      with ThreadPoolExecutor(max_workers=self._strip_jobs) as executor:
+        sizes = list(executor.map( \
+          lambda paths: self._split_debug_info_file(objcopy, paths), items))
+
+      size_before = sum(before for before, _ in sizes)
+      size_after = sum(after for _, after in sizes)
+      self.output.info('stripped {} files: {} MiB -> {} MiB, debug info in {}'.format( \
+        len(items), size_before // (1024 * 1024), size_after // (1024 * 1024), \
+        self._debug_info_folder))
+
+    @property
+    def _package_size_report_path(self):
+      return '{}.package_size.json'.format(self.build_folder.rstrip(os.sep))
+
+    # Compares package size with size of `package_layout=full`.
+    # For `lean` layout size of `full` layout is estimated
+    # as package size without installed stage_llvm files,
+    # plus size of folders copied by `full` layout.
+    def _report_package_size(self):
+      package_size = self._folder_size(self.package_folder)
+      stage_llvm_size = self._folder_size(self._stage_llvm_install_folder) \
+        if self.options.package_layout == "lean" else 0
+      full_layout_folders = {}
+      for src, dst in self._package_full_layout_folders:
+        full_layout_folders[dst] = self._folder_size(src)
+      if self.options.package_layout == "lean":
+        full_layout_size = package_size - stage_llvm_size + sum(full_layout_folders.values())
+      else:
+        full_layout_size = package_size
+
+      report = { \
+        "package_layout": str(self.options.package_layout), \
+        "package_size": package_size, \
+        "full_layout_size": full_layout_size, \
+        "full_layout_folders": full_layout_folders, \
+        "package_folders": { name: self._folder_size(os.path.join(self.package_folder, name)) \
+          for name in sorted(os.listdir(self.package_folder)) \
+          if os.path.isdir(os.path.join(self.package_folder, name)) }, \
+      }
+      try:
+        with open(self._package_size_report_path, 'w') as f:
+          json.dump(report, f, indent=2, sort_keys=True)
+      except (OSError, IOError) as e:
+        self.output.warn('unable to write package size report: {}'.format(e))
+
+      saved = full_layout_size - package_size
+      self.output.info('package size ({} layout): {} MiB, full layout: {} MiB, saved: {} MiB ({:.1f}%)'.format( \
+        report["package_layout"], package_size // (1024 * 1024), full_layout_size // (1024 * 1024), \
+        saved // (1024 * 1024), 100.0 * saved / full_layout_size if full_layout_size else 0.0))
+      self.output.info('package size report: {}'.format(self._package_size_report_path))
+
     # NOTE: do not append packaged paths to env_info.PATH, env_info.LD_LIBRARY_PATH, etc.
     # because it can conflict with system compiler
     # https://stackoverflow.com/q/54273632
@@ -1882,25 +4204,34 @@ class LLVM9Conan(ConanFile):
         if not "clang" in llvm_projects:
             raise Exception("enable project clang")
 
+        parts = self._package_parts
+        has_devel = "devel" in parts
+
         builddirs = ['lib/cmake', 'lib/cmake/llvm', 'lib/cmake/clang']
-        if not self.options.add_to_builddirs:
+        if not self.options.add_to_builddirs or not has_devel:
           builddirs = []
         self.cpp_info.components["builddirs"].builddirs = builddirs
 
         libdirs = ["lib", "clang/lib", "tools/clang/lib"]
-        if not self.options.add_to_libdirs:
+        if self.options.package_layout == "lean":
+          libdirs = ["lib"]
+        if not self.options.add_to_libdirs or not has_devel:
           libdirs = []
         self.cpp_info.components["libdirs"].libdirs = libdirs
 
         includedirs = ["include", "clang/include", "tools/clang/include"]
         includedirs.append(os.path.join(self.package_folder, "include"))
         includedirs.append(self.package_folder)
-        if not self.options.add_to_includedirs:
+        if self.options.package_layout == "lean":
+          includedirs = ["include"]
+        if not self.options.add_to_includedirs or not has_devel:
           includedirs = []
         self.cpp_info.components["includedirs"].includedirs = includedirs
 
         bindirs = ["bin", "libexec", "clang", "tools", "tools/clang"]
-        if not self.options.add_to_bindirs:
+        if self.options.package_layout == "lean":
+          bindirs = ["bin", "libexec"]
+        if not self.options.add_to_bindirs or parts == ["runtime"]:
           bindirs = []
         self.cpp_info.components["bindirs"].bindirs = bindirs
         # paths to clang-format etc.
@@ -1927,7 +4258,67 @@ class LLVM9Conan(ConanFile):
              Version(self.settings.compiler.version.value) == "9.0" and self._libcxx == "libc++"):
               system_libs.append("atomic")
 
-        if self.options.link_with_llvm_libs:
+        if "runtime" in parts and not has_devel:
+          # libc++ and compiler-rt only
+          self.cpp_info.components["runtime"].names["cmake_find_package"] = "llvm_runtime"
+          self.cpp_info.components["runtime"].names["cmake_find_package_multi"] = "llvm_runtime"
+          self.cpp_info.components["runtime"].libdirs = ["lib"]
+          self.cpp_info.components["runtime"].includedirs = ["include/c++/v1"]
+          self.cpp_info.components["runtime"].libs = ["c++", "c++abi"]
+
+        link_with_llvm_libs = self.options.link_with_llvm_libs and has_devel
+        llvm_components = self._read_llvm_components() if link_with_llvm_libs else None
+
+        if link_with_llvm_libs and self.options.dylib:
+          # single libLLVM and libclang-cpp instead of per-library components
+          self.cpp_info.components["llvm_core"].names["cmake_find_package"] = "llvm_core"
+          self.cpp_info.components["llvm_core"].names["cmake_find_package_multi"] = "llvm_core"
+          self.cpp_info.components["llvm_core"].libs = ["LLVM"]
+          self.cpp_info.components["llvm_core"].system_libs = system_libs
+
+          if self.resolve_option("clang"):
+            self.cpp_info.components["clang_core"].names["cmake_find_package"] = "clang_core"
+            self.cpp_info.components["clang_core"].names["cmake_find_package_multi"] = "clang_core"
+            self.cpp_info.components["clang_core"].libs = ["clang-cpp"]
+            self.cpp_info.components["clang_core"].requires = ["llvm_core"]
+            self.cpp_info.components["clang_core"].system_libs = system_libs
+        elif link_with_llvm_libs and llvm_components is not None:
+          # per-library components with dependencies from installed cmake exports,
+          # consumer of `clangTooling` links only its dependencies
+          enabled_llvm_libs = [library for library in llvm_libs \
+            if getattr(self.options, 'with_' + library) and library in llvm_components]
+          # add dependencies of enabled libs, so every `requires` is valid
+          libs_to_add = list(enabled_llvm_libs)
+          added_libs = set()
+          while libs_to_add:
+            lib = libs_to_add.pop()
+            if lib in added_libs:
+              continue
+            added_libs.add(lib)
+            libs_to_add.extend(llvm_components[lib]["requires"])
+          self.output.info('Enabled LLVM libs: {}'.format(', '.join(enabled_llvm_libs)))
+
+          for lib in sorted(added_libs):
+            self.cpp_info.components[lib].names["cmake_find_package"] = lib
+            self.cpp_info.components[lib].names["cmake_find_package_multi"] = lib
+            self.cpp_info.components[lib].libs = [lib]
+            self.cpp_info.components[lib].requires = llvm_components[lib]["requires"]
+            self.cpp_info.components[lib].builddirs = builddirs
+            self.cpp_info.components[lib].libdirs = libdirs
+            self.cpp_info.components[lib].includedirs = includedirs
+            if self.options.add_to_system_libs:
+              self.cpp_info.components[lib].system_libs = llvm_components[lib]["system_libs"]
+
+          # all enabled libs (as in predefined lists below)
+          self.cpp_info.components["llvm_core"].names["cmake_find_package"] = "llvm_core"
+          self.cpp_info.components["llvm_core"].names["cmake_find_package_multi"] = "llvm_core"
+          self.cpp_info.components["llvm_core"].requires = \
+            [lib for lib in enabled_llvm_libs if lib in llvm_core_libs]
+          self.cpp_info.components["clang_core"].names["cmake_find_package"] = "clang_core"
+          self.cpp_info.components["clang_core"].names["cmake_find_package_multi"] = "clang_core"
+          self.cpp_info.components["clang_core"].requires = \
+            [lib for lib in enabled_llvm_libs if lib in clang_core_libs]
+        elif link_with_llvm_libs:
           # clang libs
           self.cpp_info.components["clang_core"].names["cmake_find_package"] = "clang_core"
           self.cpp_info.components["clang_core"].names["cmake_find_package_multi"] = "clang_core"
@@ -1995,6 +4386,9 @@ class LLVM9Conan(ConanFile):
     # You must use same CXX ABI as LLVM libs
     # otherwise you will get link errors!
     def package_id(self):
+      if not self.options.split_debug_info:
+        self.info.options.package_debug_info = False
+
       # we changed compiler mid-way
       if self._stage_tmp_compiler_enabled:
         self.info.settings.compiler=os.getenv("LLVM_CONAN_PACKAGE_ID_COMILER_NAME", "clang")